@@ -0,0 +1,68 @@
+"""Measure how much of the source and destination files
+stay in the page cache after a copy, with and without
+--nocache and --direct.
+
+Linux only. Usage: python cache_footprint.py [SIZE_MIB]
+
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import sys
+import typing
+
+from pycp.main import main as pycp_main
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def resident_percent(path: str) -> float:
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0.0
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vec = (ctypes.c_ubyte * pages)()
+    with open(path, "rb") as fp:
+        mapped = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_COPY)
+        start = ctypes.c_char.from_buffer(mapped)
+        ret = libc.mincore(ctypes.byref(start), ctypes.c_size_t(size), vec)
+        # Release the export before closing the mapping
+        del start
+        mapped.close()
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    resident = sum(x & 1 for x in vec)
+    return 100.0 * resident / pages
+
+
+def copy(options: typing.List[str]) -> None:
+    if os.path.exists("dest.dat"):
+        os.remove("dest.dat")
+    sys.argv = ["pycp", *options, "src.dat", "dest.dat"]
+    pycp_main()
+
+
+def main() -> None:
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    with open("src.dat", "wb") as fp:
+        for _ in range(size_mib):
+            fp.write(os.urandom(1024 * 1024))
+    os.sync()
+
+    all_options: typing.List[typing.List[str]] = [[], ["--nocache"], ["--direct"]]
+    for options in all_options:
+        copy(options)
+        label = " ".join(options) or "(default)"
+        print(
+            f"{label:12} src: {resident_percent('src.dat'):5.1f}% "
+            f"dest: {resident_percent('dest.dat'):5.1f}% cached"
+        )
+    os.remove("src.dat")
+    os.remove("dest.dat")
+
+
+if __name__ == "__main__":
+    main()
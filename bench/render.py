@@ -0,0 +1,57 @@
+"""Measure how many progress frames per second pycp renders,
+for both progress indicators.
+
+Frames are written to /dev/null, so only the cost of
+building and writing them is measured.
+
+Usage: python render.py [SECONDS]
+
+"""
+
+import contextlib
+import os
+import sys
+import time
+
+from pycp.progress import GlobalIndicator, OneFileIndicator, Progress, ProgressIndicator
+
+
+def make_progress() -> Progress:
+    progress = Progress()
+    progress.index = 42
+    progress.count = 1000
+    progress.src = "/home/user/Music/Some Artist/Some Album/01 Some Song.flac"
+    progress.dest = "/media/backup/Music/Some Artist/Some Album/01 Some Song.flac"
+    progress.file_size = 30 * 1024 * 1024
+    progress.total_size = 10 * 1024**3
+    return progress
+
+
+def frames_per_second(indicator: ProgressIndicator, duration: float) -> float:
+    progress = make_progress()
+    frames = 0
+    start = time.perf_counter()
+    end = start + duration
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        indicator.on_new_file(progress)
+        while time.perf_counter() < end:
+            for _ in range(100):
+                progress.file_done = (progress.file_done + 4096) % progress.file_size
+                progress.total_done += 4096
+                progress.file_elapsed += 0.001
+                progress.total_elapsed += 0.001
+                indicator.on_progress(progress)
+            frames += 100
+    return frames / (time.perf_counter() - start)
+
+
+def main() -> None:
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    for indicator in (OneFileIndicator(), GlobalIndicator()):
+        name = type(indicator).__name__
+        fps = frames_per_second(indicator, duration)
+        print("%-17s %9.0f frames/s" % (name, fps))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,296 @@
+"""Benchmark suite for pycp and pymv.
+
+Runs a matrix of workloads and modes, each one in a separate
+process, and reports throughput, CPU time and peak RSS.
+
+Results are stored as JSON, so that two versions can be
+compared:
+
+    python bench/run.py --output before.json
+    git checkout my-branch
+    python bench/run.py --output after.json --compare before.json
+
+Cross-device benchmarks need a directory on an other
+filesystem, given with --other-dir.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
 import sys
+import tempfile
+import time
+import typing
+
+MiB = 1024 * 1024
+
+# Runs the real entry point, with sys.argv[0] set to pycp or pymv
+LAUNCHER = "import sys; from pycp.main import main; sys.argv = sys.argv[1:]; main()"
+
+
+class Workload(typing.NamedTuple):
+    name: str
+    create: typing.Callable[[str, float], None]
+
+
+def write_file(path: str, size: int) -> None:
+    block = os.urandom(min(size, MiB))
+    with open(path, "wb") as fp:
+        remaining = size
+        while remaining > 0:
+            fp.write(block[:remaining])
+            remaining -= len(block)
+
+
+def create_huge_file(path: str, scale: float) -> None:
+    os.mkdir(path)
+    write_file(os.path.join(path, "huge.dat"), int(512 * MiB * scale))
+
+
+def create_small_files(path: str, scale: float) -> None:
+    count = int(20_000 * scale)
+    for i in range(count):
+        sub_dir = os.path.join(path, "dir_%03d" % (i // 1000))
+        if i % 1000 == 0:
+            os.makedirs(sub_dir)
+        write_file(os.path.join(sub_dir, "file_%05d" % i), i % 4096)
+
+
+def create_deep_tree(path: str, scale: float) -> None:
+    depth = max(1, int(100 * scale))
+    current = path
+    for level in range(depth):
+        current = os.path.join(current, "level_%03d" % level)
+        os.makedirs(current)
+        for i in range(10):
+            write_file(os.path.join(current, "file_%d" % i), 16 * 1024)
+
+
+def create_sparse_file(path: str, scale: float) -> None:
+    os.mkdir(path)
+    size = int(2048 * MiB * scale)
+    data = os.urandom(MiB)
+    with open(os.path.join(path, "sparse.img"), "wb") as fp:
+        # A few data extents in a large hole
+        for offset in range(0, size, size // 8):
+            fp.seek(offset)
+            fp.write(data)
+        fp.truncate(size)
+
+
+WORKLOADS = [
+    Workload("huge-file", create_huge_file),
+    Workload("small-files", create_small_files),
+    Workload("deep-tree", create_deep_tree),
+    Workload("sparse-file", create_sparse_file),
+]
 
-from pycp.main import main as pycp_main
+
+class Mode(typing.NamedTuple):
+    name: str
+    prog: str
+    args: typing.List[str]
+    cross_device: bool = False
+
+
+MODES = [
+    Mode("copy", "pycp", ["--progress=bar"]),
+    Mode("copy-global", "pycp", ["--progress=bar", "--global-pbar"]),
+    Mode("copy-no-progress", "pycp", ["--progress=none"]),
+    Mode("move", "pymv", ["--progress=bar"]),
+    Mode("copy-cross-device", "pycp", ["--progress=bar"], cross_device=True),
+    Mode("move-cross-device", "pymv", ["--progress=bar"], cross_device=True),
+]
+
+
+def tree_stats(path: str) -> typing.Tuple[int, int]:
+    """Return the number of files and their apparent size"""
+    count = 0
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            count += 1
+            size += os.lstat(os.path.join(dir_path, file_name)).st_size
+    return count, size
+
+
+def run_once(mode: Mode, src: str, dest: str) -> typing.Dict[str, float]:
+    """Run pycp or pymv in a child process, returning its wall
+    time, CPU time and peak RSS
+
+    """
+    cmd = [sys.executable, "-c", LAUNCHER, mode.prog, *mode.args, src, dest]
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(cmd, stdout=devnull)
+        # Unlike getrusage(RUSAGE_CHILDREN), wait4() reports
+        # the resources used by this child only
+        _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return {
+        "wall": wall,
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        # KiB on Linux, bytes on macOS
+        "max_rss": rusage.ru_maxrss,
+    }
+
+
+def run_benchmark(
+    workload: Workload, mode: Mode, work_dir: str, dest_dir: str, args: typing.Any
+) -> typing.Dict[str, typing.Any]:
+    src = os.path.join(work_dir, "src-" + workload.name)
+    if not os.path.exists(src):
+        workload.create(src, args.scale)
+    count, size = tree_stats(src)
+    moving = mode.prog == "pymv"
+    runs = list()
+    for _ in range(args.runs):
+        dest = os.path.join(dest_dir, "dest")
+        run_src = src
+        if moving:
+            # Move a fresh copy, created outside of the timed run
+            run_src = os.path.join(work_dir, "moved-" + workload.name)
+            workload.create(run_src, args.scale)
+        try:
+            subprocess.check_call(["sync"])
+            runs.append(run_once(mode, run_src, dest))
+        finally:
+            shutil.rmtree(dest, ignore_errors=True)
+            if moving:
+                shutil.rmtree(run_src, ignore_errors=True)
+
+    wall = statistics.median(x["wall"] for x in runs)
+    return {
+        "workload": workload.name,
+        "mode": mode.name,
+        "files": count,
+        "bytes": size,
+        "wall": wall,
+        "mb_per_s": size / MiB / wall,
+        "files_per_s": count / wall,
+        "cpu": statistics.median(x["cpu"] for x in runs),
+        "max_rss": max(x["max_rss"] for x in runs),
+        "runs": runs,
+    }
+
+
+def get_metadata() -> typing.Dict[str, typing.Any]:
+    version = subprocess.check_output(
+        [sys.executable, "-c", LAUNCHER, "pycp", "--version"], text=True
+    ).strip()
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "version": version,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def print_result(
+    result: typing.Dict[str, typing.Any],
+    previous: typing.Optional[typing.Dict[str, typing.Any]],
+) -> None:
+    line = "%-12s %-18s %9.1f MB/s %9.0f files/s %7.2fs CPU %8d KiB RSS" % (
+        result["workload"],
+        result["mode"],
+        result["mb_per_s"],
+        result["files_per_s"],
+        result["cpu"],
+        result["max_rss"],
+    )
+    if previous:
+        line += "  (x%.2f)" % (previous["wall"] / result["wall"])
+    print(line, flush=True)
+
+
+# Results of a previous run, by (workload, mode)
+PreviousResults = typing.Dict[typing.Tuple[str, str], typing.Dict[str, typing.Any]]
+
+
+def load_previous(path: typing.Optional[str]) -> PreviousResults:
+    if not path:
+        return {}
+    with open(path) as fp:
+        data = json.load(fp)
+    return {(x["workload"], x["mode"]): x for x in data["results"]}
 
 
 def main() -> None:
-    sys.argv = ["pycp", "src.dat", "dest.dat"]
-    pycp_main()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--work-dir", help="where to create the sources (default: a temp dir)"
+    )
+    parser.add_argument(
+        "--other-dir", help="directory on an other filesystem, for cross-device runs"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="runs per benchmark")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="scale the size of the workloads"
+    )
+    parser.add_argument(
+        "--workload",
+        action="append",
+        choices=[x.name for x in WORKLOADS],
+        help="only run these workloads",
+    )
+    parser.add_argument(
+        "--mode",
+        action="append",
+        choices=[x.name for x in MODES],
+        help="only run these modes",
+    )
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", help="results of a previous run")
+    args = parser.parse_args()
+
+    previous = load_previous(args.compare)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="pycp-bench-")
+    other_dir = args.other_dir
+    if other_dir and os.stat(other_dir).st_dev == os.stat(work_dir).st_dev:
+        sys.exit("%s is on the same filesystem as %s" % (other_dir, work_dir))
+
+    results = list()
+    try:
+        for workload in WORKLOADS:
+            if args.workload and workload.name not in args.workload:
+                continue
+            for mode in MODES:
+                if args.mode and mode.name not in args.mode:
+                    continue
+                if mode.cross_device and not other_dir:
+                    continue
+                dest_dir = other_dir if mode.cross_device else work_dir
+                assert dest_dir
+                result = run_benchmark(workload, mode, work_dir, dest_dir, args)
+                previous_result = previous.get((workload.name, mode.name))
+                print_result(result, previous_result)
+                results.append(result)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as fp:
+        json.dump({"metadata": get_metadata(), "results": results}, fp, indent=2)
+    print("Results written to", args.output)
 
 
 if __name__ == "__main__":
@@ -1,2 +1,6 @@
-python -m cProfile -o pycp.cprof -s cumulative run.py
+# Profile pycp copying one huge file
+mkdir -p /tmp/pycp-profile
+python -c 'import os; open("/tmp/pycp-profile/src.dat", "wb").write(os.urandom(512 * 1024 * 1024))'
+python -m cProfile -o pycp.cprof -s cumulative -m pycp.main /tmp/pycp-profile/src.dat /tmp/pycp-profile/dest.dat
 pyprof2calltree -k -i pycp.cprof
+rm -rf /tmp/pycp-profile
@@ -0,0 +1,56 @@
+"""Measure how many small files per second pycp copies,
+with and without the small files fast path.
+
+Usage: python small_files.py [COUNT]
+
+"""
+
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pycp.transfer
+from pycp.main import main as pycp_main
+
+
+def make_tree(path: str, count: int) -> None:
+    for i in range(count):
+        sub_dir = os.path.join(path, "dir_%03d" % (i // 1000))
+        if i % 1000 == 0:
+            os.makedirs(sub_dir)
+        with open(os.path.join(sub_dir, "file_%05d" % i), "wb") as fp:
+            fp.write(os.urandom(i % 4096))
+
+
+def files_per_second(src: str, dest: str, count: int) -> float:
+    sys.argv = ["pycp", src, dest]
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        pycp_main()
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(dest)
+    return count / elapsed
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "src")
+        dest = os.path.join(tmp, "dest")
+        make_tree(src, count)
+
+        small_file_size = pycp.transfer.SMALL_FILE_SIZE
+        pycp.transfer.SMALL_FILE_SIZE = 0
+        slow = files_per_second(src, dest, count)
+        pycp.transfer.SMALL_FILE_SIZE = small_file_size
+        fast = files_per_second(src, dest, count)
+
+    print("regular path:    %8.0f files/s" % slow)
+    print("small file path: %8.0f files/s (x%.1f)" % (fast, fast / slow))
+
+
+if __name__ == "__main__":
+    main()
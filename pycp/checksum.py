@@ -0,0 +1,112 @@
+"""This module contains the Hasher class, used by --verify to
+compute checksums while the data is being copied, and helpers
+to hash existing files and write checksum manifests.
+
+"""
+
+import hashlib
+import os
+import queue
+import threading
+import typing
+
+from pycp.engine import fadvise, get_buffer
+
+# Checksums that can be used with --verify-with. shake_*
+# algorithms are left out, since they need a digest length
+ALGORITHMS = sorted(
+    x for x in hashlib.algorithms_guaranteed if not x.startswith("shake_")
+)
+
+# Smaller chunks are hashed on the calling thread, since starting
+# a thread would cost more than hashing them
+THREAD_MIN_SIZE = 1024 * 1024
+
+# Maximum number of chunks waiting to be hashed
+QUEUE_SIZE = 4
+
+# Size of the chunks read when hashing whole files
+READ_SIZE = 1024 * 1024
+
+# (destination, hex digest) of a transferred file
+ManifestEntry = typing.Tuple[str, str]
+
+
+class Hasher:
+    """Compute the digest of data given in chunks.
+
+    Large chunks are hashed on a separate thread, so that
+    hashing overlaps with the I/O of the next chunks.
+    hashlib releases the GIL while hashing them
+
+    """
+
+    def __init__(self, algorithm: str) -> None:
+        self._hash = hashlib.new(algorithm)
+        self._queue: "queue.Queue[typing.Optional[bytes]]" = queue.Queue(QUEUE_SIZE)
+        self._thread: typing.Optional[threading.Thread] = None
+        self.length = 0
+
+    def update(self, data: memoryview) -> None:
+        self.length += len(data)
+        if self._thread is None and len(data) < THREAD_MIN_SIZE:
+            self._hash.update(data)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        # The copy re-uses its buffer for the next chunk
+        self._queue.put(bytes(data))
+
+    def _run(self) -> None:
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self._hash.update(data)
+
+    def close(self) -> None:
+        """Wait until every chunk is hashed"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def hexdigest(self) -> str:
+        self.close()
+        return self._hash.hexdigest()
+
+
+def file_digest(path: str, algorithm: str) -> str:
+    """Compute the digest of a file.
+
+    Its pages are dropped from the cache first, so that what
+    is really on disk gets read, as long as the file was
+    flushed beforehand
+
+    """
+    hasher = Hasher(algorithm)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fadvise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+        fadvise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        view = memoryview(get_buffer(READ_SIZE))[:READ_SIZE]
+        while True:
+            read = os.readv(fd, [view])
+            if not read:
+                break
+            hasher.update(view[:read])
+    finally:
+        os.close(fd)
+        hasher.close()
+    return hasher.hexdigest()
+
+
+def write_manifest(path: str, entries: typing.Iterable[ManifestEntry]) -> None:
+    """Write a manifest in the format used by sha256sum and
+    friends, so that it can be checked with `sha256sum -c`
+
+    """
+    with open(path, "w") as fp:
+        for dest, digest in sorted(entries):
+            fp.write("%s  %s\n" % (digest, dest))
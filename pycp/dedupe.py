@@ -0,0 +1,107 @@
+"""This module contains the DuplicateFinder class, used by
+--dedupe to find source files with the same contents.
+
+Files are first grouped by size, which costs nothing since the
+scan already has it. Only when two files have the same size is
+the beginning of their data hashed, and only when those hashes
+match is the rest of their data hashed too.
+
+"""
+
+import hashlib
+import typing
+
+ALGORITHM = "blake2b"
+
+# Number of bytes hashed to tell apart files with the same size
+HEAD_SIZE = 64 * 1024
+
+# Size of the chunks read when hashing whole files
+READ_SIZE = 1024 * 1024
+
+
+def hash_file(path: str, limit: typing.Optional[int] = None) -> bytes:
+    """Return the digest of the first limit bytes of a
+    file, or of the whole file if limit is None
+
+    """
+    hasher = hashlib.new(ALGORITHM)
+    with open(path, "rb") as fp:
+        if limit is not None:
+            hasher.update(fp.read(limit))
+        else:
+            for chunk in iter(lambda: fp.read(READ_SIZE), b""):
+                hasher.update(chunk)
+    return hasher.digest()
+
+
+class Candidate:
+    """A file that later files may be duplicates of.
+    Its digests are only computed when needed
+
+    """
+
+    __slots__ = ("src", "dest", "size", "_head", "_full")
+
+    def __init__(self, src: str, dest: str, size: int) -> None:
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self._head: typing.Optional[bytes] = None
+        self._full: typing.Optional[bytes] = None
+
+    def head_digest(self) -> bytes:
+        if self._head is None:
+            self._head = hash_file(self.src, HEAD_SIZE)
+        return self._head
+
+    def full_digest(self) -> bytes:
+        if self.size <= HEAD_SIZE:
+            return self.head_digest()
+        if self._full is None:
+            self._full = hash_file(self.src)
+        return self._full
+
+
+class DuplicateFinder:
+    """Remember the files found during the scan, and tell
+    whether a new file has the same contents as one of them
+
+    """
+
+    def __init__(self) -> None:
+        # Files whose head was not hashed yet, by size. Sizes
+        # found only once stay here
+        self.by_size: typing.Dict[int, typing.List[Candidate]] = dict()
+        # Files with a hashed head, by (size, head digest)
+        self.by_head: typing.Dict[
+            typing.Tuple[int, bytes], typing.List[Candidate]
+        ] = dict()
+
+    def find(self, src: str, dest: str, size: int) -> typing.Optional[str]:
+        """Return the destination of a previous file with the
+        same contents as src, or None if there is none.
+
+        In the latter case, src is remembered as a new candidate
+
+        """
+        candidate = Candidate(src, dest, size)
+        unhashed = self.by_size.get(size)
+        if unhashed is None:
+            self.by_size[size] = [candidate]
+            return None
+        try:
+            while unhashed:
+                # Unreadable candidates are dropped
+                other = unhashed.pop()
+                key = (size, other.head_digest())
+                self.by_head.setdefault(key, list()).append(other)
+            same_head = self.by_head.setdefault((size, candidate.head_digest()), list())
+            for other in same_head:
+                if other.full_digest() == candidate.full_digest():
+                    return other.dest
+        except OSError:
+            # Can't tell, so transfer it as usual
+            return None
+        same_head.append(candidate)
+        return None
@@ -0,0 +1,731 @@
+"""This module contains the low-level copy engine used
+by FileTransferManager.
+
+On copy-on-write filesystems, files can be cloned with
+the FICLONE and FICLONERANGE ioctls.
+
+Otherwise, data is copied in the kernel when possible, using
+copy_file_range(2) first and sendfile(2) on Linux as a second tier,
+and falls back to a read/write loop in userspace otherwise.
+
+Sparse files can be copied extent by extent, using
+lseek(2) with SEEK_DATA and SEEK_HOLE.
+
+Finally, the page cache can be spared with posix_fadvise(2),
+or bypassed entirely with O_DIRECT.
+
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+# Bounds of the chunk size used for userspace copies,
+# see ChunkSize
+INITIAL_BLOCKS_PER_CHUNK = 32
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+SAMPLES_PER_CHUNK_SIZE = 4
+
+# Granularity used to find blocks full of zeros when
+# making sparse copies
+SPARSE_BLOCK_SIZE = 4096
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+# With --nocache, pages are dropped from the cache every
+# NOCACHE_WINDOW bytes
+NOCACHE_WINDOW = 8 * 1024 * 1024
+
+# O_DIRECT requires buffers, offsets and lengths aligned
+# on the logical block size of the device. Page size is
+# a safe bet
+DIRECT_ALIGNMENT = mmap.PAGESIZE
+DIRECT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# With --delta, source and destination are compared in chunks
+# of DELTA_CHUNK_SIZE, and only the DELTA_BLOCK_SIZE blocks
+# that differ are written
+DELTA_CHUNK_SIZE = 1024 * 1024
+DELTA_BLOCK_SIZE = 64 * 1024
+
+# Kernel-side copies can use larger chunks, since the data
+# never enters userspace. This still gives the progress
+# callback a chance to run several times per second
+KERNEL_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning "this syscall cannot be used for this pair of files",
+# as opposed to real I/O errors
+FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.ENOTSOCK,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+# From linux/fs.h
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940D
+
+REFLINK_ERRNOS = FALLBACK_ERRNOS | {errno.ENOTTY}
+
+Callback = typing.Callable[[int], None]
+# Called with the data of each chunk, when it goes through userspace
+DataCallback = typing.Callable[[memoryview], None]
+
+
+class ReflinkUnsupported(Exception):
+    """Raised when files cannot be cloned"""
+
+
+def reflink(src_fd: int, dest_fd: int, offset: int = 0, length: int = 0) -> None:
+    """Make dest_fd share its data with src_fd, without copying it.
+
+    The whole file is cloned with FICLONE by default.
+    When offset or length are given, only this range is cloned
+    with FICLONERANGE, at the same offset in the destination.
+    A length of 0 means "up to the end of the source file".
+
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise ReflinkUnsupported("not supported on this platform")
+    try:
+        if offset == 0 and length == 0:
+            fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        else:
+            clone_range = struct.pack("qQQQ", src_fd, offset, length, offset)
+            fcntl.ioctl(dest_fd, FICLONERANGE, clone_range)
+    except OSError as err:
+        if err.errno in REFLINK_ERRNOS:
+            raise ReflinkUnsupported(err.strerror) from err
+        raise
+
+
+def can_reflink(directory: str) -> bool:
+    """Check if files can be cloned in directory, by cloning
+    a small temporary file there
+
+    """
+    try:
+        with tempfile.TemporaryFile(dir=directory) as src_file:
+            with tempfile.TemporaryFile(dir=directory) as dest_file:
+                src_file.write(b"pycp")
+                src_file.flush()
+                reflink(src_file.fileno(), dest_file.fileno())
+    except (OSError, ReflinkUnsupported):
+        return False
+    return True
+
+
+class KernelCopyUnsupported(Exception):
+    """Raised when a kernel-side copy cannot be used,
+    and the next tier should be tried
+
+    """
+
+
+def _kernel_copy_loop(
+    copy_chunk: typing.Callable[[int, int, int], int],
+    src_fd: int,
+    dest_fd: int,
+    chunk_size: int,
+    callback: Callback,
+    length: typing.Optional[int],
+) -> None:
+    remaining = length
+    while remaining is None or remaining > 0:
+        count = chunk_size if remaining is None else min(chunk_size, remaining)
+        try:
+            copied = copy_chunk(src_fd, dest_fd, count)
+        except OSError as err:
+            if err.errno in FALLBACK_ERRNOS:
+                raise KernelCopyUnsupported() from err
+            raise
+        if not copied:
+            return
+        if remaining is not None:
+            remaining -= copied
+        callback(copied)
+
+
+def _copy_file_range_chunk(src_fd: int, dest_fd: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dest_fd, count)
+
+
+def _sendfile_chunk(src_fd: int, dest_fd: int, count: int) -> int:
+    return os.sendfile(dest_fd, src_fd, None, count)
+
+
+def kernel_copy_tiers() -> typing.List[typing.Callable[[int, int, int], int]]:
+    res: typing.List[typing.Callable[[int, int, int], int]] = list()
+    if hasattr(os, "copy_file_range"):
+        res.append(_copy_file_range_chunk)
+    # Elsewhere, sendfile() only writes to sockets, and
+    # requires an explicit offset
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        res.append(_sendfile_chunk)
+    return res
+
+
+class ChunkSize:
+    """Choose how many bytes to copy at once in userspace.
+
+    By default, start from a multiple of the preferred I/O size of the
+    files (st_blksize), then keep doubling the chunk size while this
+    improves the measured throughput, up to MAX_CHUNK_SIZE.
+
+    When fixed is given, always use this size instead.
+
+    """
+
+    def __init__(self, blksize: int = 4096, fixed: typing.Optional[int] = None) -> None:
+        self.adaptive = fixed is None
+        if fixed is None:
+            initial = max(blksize, 4096) * INITIAL_BLOCKS_PER_CHUNK
+            self.size = min(initial, MAX_CHUNK_SIZE)
+        else:
+            self.size = fixed
+        self._best_throughput = 0.0
+        self._best_size = self.size
+        self._sample_bytes = 0
+        self._sample_time = 0.0
+        self._sample_count = 0
+
+    @classmethod
+    def for_files(
+        cls, src_fd: int, dest_fd: int, fixed: typing.Optional[int] = None
+    ) -> "ChunkSize":
+        if fixed is not None:
+            return cls(fixed=fixed)
+        blksize = max(os.fstat(src_fd).st_blksize, os.fstat(dest_fd).st_blksize)
+        return cls(blksize=blksize)
+
+    def update(self, transferred: int, elapsed: float) -> None:
+        """Called after each chunk, with the number of bytes
+        transferred and how long it took
+
+        """
+        if not self.adaptive:
+            return
+        self._sample_bytes += transferred
+        self._sample_time += elapsed
+        self._sample_count += 1
+        if self._sample_count < SAMPLES_PER_CHUNK_SIZE or self._sample_time <= 0:
+            return
+        throughput = self._sample_bytes / self._sample_time
+        self._sample_bytes = 0
+        self._sample_time = 0.0
+        self._sample_count = 0
+        if throughput > self._best_throughput * 1.1:
+            self._best_throughput = throughput
+            self._best_size = self.size
+            if self.size * 2 <= MAX_CHUNK_SIZE:
+                self.size *= 2
+                return
+        # Bigger chunks no longer help: settle for the best size
+        self.size = self._best_size
+        self.adaptive = False
+
+
+_local = threading.local()
+
+
+def get_buffer(size: int) -> bytearray:
+    """Return a buffer of at least size bytes.
+
+    The same buffer is re-used by every copy made on the
+    current thread, so that we don't have to allocate
+    memory for each chunk or even each file
+
+    """
+    buffer: typing.Optional[bytearray] = getattr(_local, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _local.buffer = buffer
+    return buffer
+
+
+def write_all(fd: int, data: memoryview) -> None:
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def pwrite_all(fd: int, data: memoryview, offset: int) -> None:
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def is_zero_block(buffer: bytearray, start: int, end: int) -> bool:
+    if end - start == SPARSE_BLOCK_SIZE:
+        # startswith() boils down to a memcmp() without copying anything
+        return buffer.startswith(ZERO_BLOCK, start)
+    return buffer.count(0, start, end) == end - start
+
+
+def write_sparse(fd: int, buffer: bytearray, length: int) -> None:
+    """Write the first length bytes of buffer to fd, seeking
+    over all-zero blocks instead of writing them, so that
+    they end up as holes in the file
+
+    """
+    view = memoryview(buffer)
+    offset = 0
+    while offset < length:
+        end = min(offset + SPARSE_BLOCK_SIZE, length)
+        is_zero = is_zero_block(buffer, offset, end)
+        # Handle consecutive blocks of the same kind at once
+        while end < length:
+            next_end = min(end + SPARSE_BLOCK_SIZE, length)
+            if is_zero_block(buffer, end, next_end) != is_zero:
+                break
+            end = next_end
+        if is_zero:
+            os.lseek(fd, end - offset, os.SEEK_CUR)
+        else:
+            write_all(fd, view[offset:end])
+        offset = end
+
+
+def userspace_copy(
+    src_fd: int,
+    dest_fd: int,
+    chunk_size: ChunkSize,
+    callback: Callback,
+    length: typing.Optional[int] = None,
+    skip_zeros: bool = False,
+    on_data: typing.Optional[DataCallback] = None,
+) -> None:
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = chunk_size.size if remaining is None else min(chunk_size.size, remaining)
+        buffer = get_buffer(size)
+        view = memoryview(buffer)
+        start = time.perf_counter()
+        read = os.readv(src_fd, [view[:size]])
+        if not read:
+            return
+        if on_data:
+            on_data(view[:read])
+        if skip_zeros:
+            write_sparse(dest_fd, buffer, read)
+        else:
+            write_all(dest_fd, view[:read])
+        chunk_size.update(read, time.perf_counter() - start)
+        if remaining is not None:
+            remaining -= read
+        callback(read)
+
+
+def copy_data(
+    src_fd: int,
+    dest_fd: int,
+    callback: Callback,
+    length: typing.Optional[int] = None,
+    buffer_size: typing.Optional[int] = None,
+    skip_zeros: bool = False,
+    on_data: typing.Optional[DataCallback] = None,
+) -> None:
+    """Copy length bytes (or everything) from src_fd to dest_fd, starting at
+    their current positions, calling callback(transferred) after each chunk
+
+    Kernel-side copies are tried first, falling back to the next
+    tier when the syscall is not supported for these files.
+
+    buffer_size is the size of the chunks copied in userspace,
+    or None to choose it automatically.
+
+    If skip_zeros is True, data is always copied in userspace, so that
+    blocks full of zeros can be left as holes in the destination.
+    The same goes when on_data is set, so that it can be called
+    with each chunk of data
+
+    """
+    tiers = [] if skip_zeros or on_data else kernel_copy_tiers()
+    for copy_chunk in tiers:
+        start = os.lseek(src_fd, 0, os.SEEK_CUR)
+        try:
+            _kernel_copy_loop(
+                copy_chunk, src_fd, dest_fd, KERNEL_CHUNK_SIZE, callback, length
+            )
+            return
+        except KernelCopyUnsupported:
+            # Some chunks may already have been copied: the
+            # next tier resumes from where the kernel stopped
+            if length is not None:
+                length -= os.lseek(src_fd, 0, os.SEEK_CUR) - start
+    chunk_size = ChunkSize.for_files(src_fd, dest_fd, fixed=buffer_size)
+    userspace_copy(src_fd, dest_fd, chunk_size, callback, length, skip_zeros, on_data)
+
+
+def delta_copy(
+    src_fd: int,
+    dest_fd: int,
+    callback: Callback,
+    block_size: int = DELTA_BLOCK_SIZE,
+    on_data: typing.Optional[DataCallback] = None,
+) -> int:
+    """Make dest identical to src, reading both files in lockstep
+    and writing only the blocks that differ.
+
+    dest must be open for reading and writing. callback() is
+    called with the number of bytes compared.
+
+    Return the number of bytes actually written
+
+    """
+    chunk_size = max(DELTA_CHUNK_SIZE, block_size)
+    buffer = get_buffer(2 * chunk_size)
+    view = memoryview(buffer)
+    src_view = view[:chunk_size]
+    dest_view = view[chunk_size : 2 * chunk_size]
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    os.lseek(dest_fd, 0, os.SEEK_SET)
+    offset = 0
+    written = 0
+    while True:
+        read = os.readv(src_fd, [src_view])
+        if not read:
+            break
+        if on_data:
+            on_data(src_view[:read])
+        dest_read = os.readv(dest_fd, [dest_view[:read]])
+        start = 0
+        while start < read:
+            end = min(start + block_size, read)
+            # Blocks past the end of dest always differ
+            if end <= dest_read and buffer.startswith(dest_view[start:end], start):
+                start = end
+                continue
+            # Write consecutive differing blocks at once
+            while end < read:
+                next_end = min(end + block_size, read)
+                if next_end <= dest_read and buffer.startswith(
+                    dest_view[end:next_end], end
+                ):
+                    break
+                end = next_end
+            pwrite_all(dest_fd, src_view[start:end], offset + start)
+            written += end - start
+            start = end
+        offset += read
+        callback(read)
+    if os.fstat(dest_fd).st_size != offset:
+        os.ftruncate(dest_fd, offset)
+    return written
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """Reserve size bytes on disk for fd, so that the file is less
+    fragmented and so that we run out of space right away rather
+    than in the middle of the copy.
+
+    Return False if the filesystem cannot do it
+
+    """
+    if not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as err:
+        if err.errno in FALLBACK_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def has_holes(fd: int, size: int) -> bool:
+    """Check if the first size bytes of a file contain holes.
+
+    Leaves the file positioned at the beginning
+
+    """
+    if not hasattr(os, "SEEK_HOLE"):
+        return False
+    try:
+        return os.lseek(fd, 0, os.SEEK_HOLE) < size
+    except OSError:
+        return False
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+
+def data_extents(fd: int, size: int) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Yield (start, end) offsets of the regions of the file which
+    actually contain data, skipping holes.
+
+    When the filesystem cannot tell, the whole file is
+    considered to be data
+
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # Only holes until the end of the file
+                return
+            if err.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def skip_hole(
+    length: int, callback: Callback, on_data: typing.Optional[DataCallback]
+) -> None:
+    if on_data:
+        zeros = memoryview(bytes(min(length, MAX_CHUNK_SIZE)))
+        remaining = length
+        while remaining > 0:
+            size = min(remaining, len(zeros))
+            on_data(zeros[:size])
+            remaining -= size
+    callback(length)
+
+
+def copy_sparse(
+    src_fd: int,
+    dest_fd: int,
+    size: int,
+    callback: Callback,
+    buffer_size: typing.Optional[int] = None,
+    skip_zeros: bool = False,
+    on_data: typing.Optional[DataCallback] = None,
+) -> None:
+    """Copy the first size bytes of src_fd to dest_fd, only
+    copying the data extents of src_fd, so that its holes
+    are preserved.
+
+    Holes are reported to the callback as if they were
+    copied, so that progress still reaches size, and
+    to on_data as zeros.
+
+    """
+    offset = 0
+    for start, end in data_extents(src_fd, size):
+        if start > offset:
+            skip_hole(start - offset, callback, on_data)
+        os.lseek(src_fd, start, os.SEEK_SET)
+        os.lseek(dest_fd, start, os.SEEK_SET)
+        copy_data(
+            src_fd,
+            dest_fd,
+            callback,
+            length=end - start,
+            buffer_size=buffer_size,
+            skip_zeros=skip_zeros,
+            on_data=on_data,
+        )
+        offset = end
+    if offset < size:
+        skip_hole(size - offset, callback, on_data)
+    # Trailing holes, if any
+    os.ftruncate(dest_fd, size)
+
+
+def same_data(src_fd: int, dest_fd: int, offset: int, length: int) -> bool:
+    """Check if both files contain the same length bytes at offset.
+
+    Does not move the file positions
+
+    """
+    end = offset + length
+    while offset < end:
+        size = min(end - offset, MAX_CHUNK_SIZE)
+        src_data = os.pread(src_fd, size, offset)
+        if not src_data or src_data != os.pread(dest_fd, size, offset):
+            return False
+        offset += len(src_data)
+    return True
+
+
+def datasync(fd: int) -> None:
+    """Flush the data of a file to disk, along with the metadata
+    needed to read it back, using fdatasync() when available
+
+    """
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def fsync_path(path: str) -> None:
+    """Flush a file or a directory to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path: str) -> None:
+    """Flush the filesystem containing path to disk, with one
+    syncfs() call on Linux, or sync() everything elsewhere
+
+    """
+    if sys.platform.startswith("linux"):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    os.sync()
+
+
+def fadvise(fd: int, offset: int, length: int, advice: str) -> None:
+    """Call posix_fadvise() when available, advice being the
+    name of a POSIX_FADV_* constant
+
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        # This is only a hint
+        pass
+
+
+class PageCacheDropper:
+    """Tell the kernel that the pages we already copied
+    won't be needed again, so that copying lots of data
+    does not evict everything else from the page cache.
+
+    Only clean pages can be dropped, so the destination is
+    flushed before being dropped at the end of the copy.
+
+    """
+
+    def __init__(self, src_fd: int, dest_fd: int) -> None:
+        self.src_fd = src_fd
+        self.dest_fd = dest_fd
+        self.done = 0
+        self.dropped = 0
+        fadvise(src_fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    def wrap(self, callback: Callback) -> Callback:
+        def on_chunk(transferred: int) -> None:
+            self.done += transferred
+            if self.done - self.dropped >= NOCACHE_WINDOW:
+                self.drop()
+            callback(transferred)
+
+        return on_chunk
+
+    def drop(self) -> None:
+        length = self.done - self.dropped
+        fadvise(self.src_fd, self.dropped, length, "POSIX_FADV_DONTNEED")
+        fadvise(self.dest_fd, self.dropped, length, "POSIX_FADV_DONTNEED")
+        self.dropped = self.done
+
+    def finish(self) -> None:
+        if self.done >= NOCACHE_WINDOW:
+            # Not worth the cost of a flush for small files
+            datasync(self.dest_fd)
+        fadvise(self.src_fd, 0, 0, "POSIX_FADV_DONTNEED")
+        fadvise(self.dest_fd, 0, 0, "POSIX_FADV_DONTNEED")
+
+
+class DirectIOUnsupported(Exception):
+    """Raised when files cannot be opened with O_DIRECT"""
+
+
+def set_direct(fd: int, enabled: bool) -> None:
+    if fcntl is None or not hasattr(os, "O_DIRECT"):
+        raise DirectIOUnsupported("O_DIRECT is not supported on this platform")
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    flags = flags | os.O_DIRECT if enabled else flags & ~os.O_DIRECT
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    except OSError as err:
+        raise DirectIOUnsupported(err.strerror) from err
+
+
+def get_aligned_buffer(size: int) -> mmap.mmap:
+    """Same as get_buffer(), but the buffer is aligned on
+    a page boundary, as required by O_DIRECT
+
+    """
+    buffer: typing.Optional[mmap.mmap] = getattr(_local, "aligned_buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = mmap.mmap(-1, size)
+        _local.aligned_buffer = buffer
+    return buffer
+
+
+def direct_copy(
+    src_fd: int,
+    dest_fd: int,
+    callback: Callback,
+    chunk_size: int = DIRECT_CHUNK_SIZE,
+) -> None:
+    """Copy everything from src_fd to dest_fd, starting at offset 0,
+    with O_DIRECT, so that data does not go through the page cache at all.
+
+    Raise DirectIOUnsupported if the filesystems do not support
+    O_DIRECT. In this case, nothing has been copied and both files
+    are back to their normal mode, at offset 0.
+
+    """
+    chunk_size = max(chunk_size - chunk_size % DIRECT_ALIGNMENT, DIRECT_ALIGNMENT)
+    view = memoryview(get_aligned_buffer(chunk_size))
+    copied = 0
+    try:
+        set_direct(src_fd, True)
+        set_direct(dest_fd, True)
+        while True:
+            read = os.readv(src_fd, [view[:chunk_size]])
+            if not read:
+                return
+            aligned = read - read % DIRECT_ALIGNMENT
+            if aligned:
+                write_all(dest_fd, view[:aligned])
+            if aligned < read:
+                # End of file: the last partial block cannot be
+                # written with O_DIRECT
+                set_direct(src_fd, False)
+                set_direct(dest_fd, False)
+                write_all(dest_fd, view[aligned:read])
+            copied += read
+            callback(read)
+    except (OSError, DirectIOUnsupported) as err:
+        if copied or (isinstance(err, OSError) and err.errno != errno.EINVAL):
+            raise
+        for fd in (src_fd, dest_fd):
+            try:
+                set_direct(fd, False)
+            except DirectIOUnsupported:
+                pass
+            os.lseek(fd, 0, os.SEEK_SET)
+        raise DirectIOUnsupported(str(err)) from err
+    finally:
+        view.release()
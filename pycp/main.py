@@ -8,13 +8,42 @@ import os
 import sys
 import typing
 
-from pycp.transfer import TransferError, TransferManager, TransferOptions
+from pycp.checksum import ALGORITHMS
+from pycp.profiling import profile
+from pycp.progress import human_readable
+from pycp.sync import POLICIES as SYNC_POLICIES
+from pycp.transfer import (
+    TransferError,
+    TransferManager,
+    TransferOptions,
+    message_stream,
+)
 
 
 def is_pymv() -> bool:
     return sys.argv[0].endswith("pymv")
 
 
+def parse_buffer_size(value: str) -> typing.Optional[int]:
+    """Parse the value of --buffer-size: 'auto', or a
+    number of bytes, optionally followed by K, M or G
+
+    """
+    if value == "auto":
+        return None
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    multiplier = multipliers.get(value[-1:].upper(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+    try:
+        res = int(value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid buffer size: %s" % value)
+    if res <= 0:
+        raise argparse.ArgumentTypeError("buffer size must be positive")
+    return res
+
+
 def parse_commandline() -> argparse.Namespace:
     """Parses command line arguments"""
     if is_pymv():
@@ -85,6 +114,205 @@ def parse_commandline() -> argparse.Namespace:
         help="display only one progress bar during transfer",
     )
 
+    parser.add_argument(
+        "--reflink",
+        choices=["auto", "always", "never"],
+        dest="reflink",
+        help="clone files on copy-on-write filesystems instead of copying data "
+        "(default: auto)",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        dest="jobs",
+        metavar="N",
+        help="transfer up to N files at once (implies --global-pbar)",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="start transferring files while the sources are still being scanned",
+    )
+
+    parser.add_argument(
+        "--buffer-size",
+        type=parse_buffer_size,
+        dest="buffer_size",
+        metavar="auto|N",
+        help="size of the chunks of data copied when the kernel cannot copy "
+        "them directly, for instance 1M (default: auto)",
+    )
+
+    parser.add_argument(
+        "--sparse",
+        choices=["auto", "always", "never"],
+        dest="sparse",
+        help="preserve holes of sparse files (auto, the default), also make "
+        "holes from blocks full of zeros (always), or write every byte (never)",
+    )
+
+    parser.add_argument(
+        "--no-space-check",
+        action="store_false",
+        dest="check_space",
+        help="start the transfer even if it does not seem to fit on the "
+        "destination filesystem",
+    )
+
+    parser.add_argument(
+        "--nocache",
+        action="store_true",
+        dest="nocache",
+        help="drop copied data from the page cache, so that other processes "
+        "keep their cached data",
+    )
+
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        dest="direct",
+        help="bypass the page cache entirely using O_DIRECT, when supported",
+    )
+
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_const",
+        const="mtime",
+        dest="skip_unchanged",
+        help="skip files whose destination has the same size and is not older "
+        "than the source",
+    )
+
+    parser.add_argument(
+        "--update-ctime",
+        action="store_const",
+        const="ctime",
+        dest="skip_unchanged",
+        help="same as --update, but also transfer files whose source changed "
+        "in any way since the destination was written",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        dest="resume",
+        help="continue interrupted transfers from the end of existing "
+        "destination files, and keep them if the transfer fails",
+    )
+
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        dest="delta",
+        help="update existing destination files in place, only writing "
+        "the blocks that changed",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_const",
+        const="sha256",
+        dest="verify",
+        help="check that each copy has the same SHA-256 checksum as its source",
+    )
+
+    parser.add_argument(
+        "--verify-with",
+        choices=ALGORITHMS,
+        dest="verify",
+        metavar="ALGORITHM",
+        help="same as --verify, using an other checksum: %s" % ", ".join(ALGORITHMS),
+    )
+
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        metavar="FILE",
+        help="write the checksums of the copied files to FILE, in the format "
+        "used by sha256sum (implies --verify)",
+    )
+
+    parser.add_argument(
+        "--progress",
+        choices=["auto", "bar", "json", "none"],
+        dest="progress",
+        help="how to display progress: bars (the default when the output is "
+        "a terminal), newline-delimited JSON events, or nothing",
+    )
+
+    parser.add_argument(
+        "--progress-fd",
+        type=int,
+        dest="progress_fd",
+        metavar="FD",
+        help="with --progress=json, write events to this file descriptor "
+        "instead of stdout",
+    )
+
+    parser.add_argument(
+        "--preserve-links",
+        action="store_true",
+        dest="preserve_links",
+        help="transfer files with several hard links once, and recreate "
+        "the other links instead of copying them again",
+    )
+
+    parser.add_argument(
+        "--dedupe",
+        action="store_const",
+        const="reflink",
+        dest="dedupe",
+        help="create files with the same contents as an other transferred file "
+        "as reflinks of its copy, when the filesystem supports it",
+    )
+
+    parser.add_argument(
+        "--dedupe-links",
+        action="store_const",
+        const="link",
+        dest="dedupe",
+        help="same as --dedupe, using hard links: duplicates will then share "
+        "their metadata, and changes",
+    )
+
+    parser.add_argument(
+        "--sync",
+        choices=SYNC_POLICIES,
+        dest="sync",
+        help="make sure the files are on disk when done: flush each file "
+        "(file), each directory (dir), or the whole destination at the "
+        "end (end). Default: none",
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        dest="stats",
+        help="print where the time went at the end of the transfer: time "
+        "spent in each phase, throughput and slowest files",
+    )
+
+    parser.add_argument(
+        "--profile",
+        choices=["cpu", "alloc"],
+        dest="profile",
+        help="profile the CPU time (with cProfile) or the memory allocations "
+        "(with tracemalloc) of the transfer, and print the hot spots",
+    )
+
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        metavar="FILE",
+        help="where to write the profile (default: pycp.prof for cpu, "
+        "pycp.snapshot for alloc)",
+    )
+
     parser.add_argument(
         "--i-love-candy", action="store_true", dest="pacman", help=argparse.SUPPRESS
     )
@@ -95,6 +323,27 @@ def parse_commandline() -> argparse.Namespace:
         ignore_errors=False,
         preserve=False,
         global_progress=False,
+        reflink="auto",
+        jobs=1,
+        stream=False,
+        buffer_size=None,
+        sparse="auto",
+        check_space=True,
+        nocache=False,
+        direct=False,
+        skip_unchanged=None,
+        resume=False,
+        delta=False,
+        verify=None,
+        manifest=None,
+        progress="auto",
+        progress_fd=None,
+        stats=False,
+        preserve_links=False,
+        dedupe=None,
+        sync="none",
+        profile=None,
+        profile_output=None,
     )
     parser.add_argument("files", nargs="+")
 
@@ -126,24 +375,52 @@ def main() -> None:
     args = parse_commandline()
     args.move = is_pymv()
 
+    if args.jobs < 1:
+        sys.exit("--jobs must be at least 1")
+    if args.jobs > 1 and args.interactive:
+        sys.exit("--interactive cannot be used with --jobs")
+    if args.manifest and not args.verify:
+        args.verify = "sha256"
+
     files = args.files
     sources, destination = parse_filelist(files)
 
     transfer_options = TransferOptions()
     transfer_options.update(args)  # type: ignore
 
-    transfer_manager = TransferManager(sources, destination, transfer_options)
     try:
-        errors = transfer_manager.do_transfer()
+        # The scan happens when creating the TransferManager
+        with profile(args.profile, args.profile_output):
+            transfer_manager = TransferManager(sources, destination, transfer_options)
+            errors = transfer_manager.do_transfer()
     except TransferError as err:
         sys.exit(str(err))
     except KeyboardInterrupt:
         sys.exit("Interrputed by user")
 
+    # Keep stdout parseable when it carries JSON progress events
+    out = message_stream(transfer_options)
+    if transfer_options.delta and transfer_manager.delta_scanned:
+        print(
+            "Delta: compared %s, wrote %s"
+            % (
+                human_readable(transfer_manager.delta_scanned),
+                human_readable(transfer_manager.delta_written),
+            ),
+            file=out,
+        )
+
+    if transfer_options.dedupe and transfer_manager.deduped_size:
+        saved = human_readable(transfer_manager.deduped_size)
+        print("Dedupe: saved %s" % saved, file=out)
+
+    if transfer_manager.stats:
+        print(transfer_manager.stats.report(), file=out)
+
     if errors:
-        print("Error occurred when transferring the following files:")
+        print("Error occurred when transferring the following files:", file=out)
         for file_name, error in errors.items():
-            print(file_name, error)
+            print(file_name, error, file=out)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+"""This module contains the profile() context manager,
+used by --profile to record where a transfer spends its
+CPU time or allocates its memory.
+
+"""
+
+import contextlib
+import cProfile
+import pstats
+import sys
+import tracemalloc
+import typing
+
+# Number of hot spots printed once the transfer is over
+TOP_COUNT = 15
+
+# Frames kept for each allocation traced with --profile=alloc
+TRACEBACK_LIMIT = 25
+
+DEFAULT_OUTPUTS = {"cpu": "pycp.prof", "alloc": "pycp.snapshot"}
+
+
+def profile(
+    kind: typing.Optional[str], output: typing.Optional[str] = None
+) -> typing.ContextManager[None]:
+    """Profile the code run in the context, if kind is "cpu"
+    or "alloc".
+
+    The profile is written to output, so that it can be
+    attached to a bug report, and a summary is printed
+
+    """
+    if kind is None:
+        return contextlib.nullcontext()
+    if output is None:
+        output = DEFAULT_OUTPUTS[kind]
+    if kind == "cpu":
+        return profile_cpu(output)
+    if kind == "alloc":
+        return profile_alloc(output)
+    raise ValueError("Unknown profile kind: %s" % kind)
+
+
+@contextlib.contextmanager
+def profile_cpu(output: str) -> typing.Iterator[None]:
+    """Profile with cProfile, and write the stats in the
+    format read by the pstats module and tools like snakeviz.
+
+    Only the calling thread is profiled: worker threads
+    started with --jobs don't show up
+
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output)
+        print("CPU profile written to", output)
+        stats = pstats.Stats(profiler, stream=sys.stdout)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_COUNT)
+
+
+@contextlib.contextmanager
+def profile_alloc(output: str) -> typing.Iterator[None]:
+    """Trace allocations with tracemalloc, and write a snapshot
+    that can be loaded with tracemalloc.Snapshot.load()
+
+    """
+    tracemalloc.start(TRACEBACK_LIMIT)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(output)
+        print("Allocation snapshot written to", output)
+        print("Peak traced memory: %.1f KiB" % (peak / 1024))
+        print("Top %d allocations by line:" % TOP_COUNT)
+        for statistic in snapshot.statistics("lineno")[:TOP_COUNT]:
+            print("  %s" % statistic)
@@ -1,7 +1,10 @@
 import abc
+import json
 import os
 import shutil
+import signal
 import sys
+import threading
 import time
 import typing
 from dataclasses import dataclass
@@ -22,11 +25,57 @@ class Progress:
         self.file_start = 0.0
         self.file_elapsed = 0.0
 
+        # Time spent flushing files to disk, with --sync
+        self.sync_elapsed = 0.0
 
-def cursor_up(nb_lines: int) -> None:
-    """Move the cursor up by nb_lines"""
-    sys.stdout.write("\033[%dA" % nb_lines)
-    sys.stdout.flush()
+
+def cursor_up_sequence(nb_lines: int) -> str:
+    """Escape sequence moving the cursor up by nb_lines"""
+    return "\033[%dA" % nb_lines
+
+
+class TerminalWidth:
+    """Cache the width of the terminal, so that it is not
+    queried for each rendered line.
+
+    The cache is refreshed when the process receives SIGWINCH,
+    once watch() has been called from the main thread
+
+    """
+
+    def __init__(self) -> None:
+        self._columns: typing.Optional[int] = None
+        self._watching = False
+
+    def get(self) -> int:
+        columns = self._columns
+        if columns is None:
+            columns = shutil.get_terminal_size().columns
+            self._columns = columns
+        return columns
+
+    def invalidate(self) -> None:
+        self._columns = None
+
+    def watch(self) -> None:
+        self.invalidate()
+        if self._watching or not hasattr(signal, "SIGWINCH"):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # Signal handlers can only be set from the main thread
+            return
+        previous = signal.getsignal(signal.SIGWINCH)
+
+        def on_resize(signum: int, frame: typing.Any) -> None:
+            self.invalidate()
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signal.SIGWINCH, on_resize)
+        self._watching = True
+
+
+terminal_width = TerminalWidth()
 
 
 def get_fraction(current_value: int, max_value: int) -> float:
@@ -252,37 +301,37 @@ class TransferText(FixedWidthComponent):
         dest = props["dest"]
         pfx, src_mid, dest_mid, sfx = describe_transfer(src, dest)
         if not pfx and not sfx:
-            components = [
-                Bold(),
-                Text(src),
-                Reset(),
-                Blue(),
-                Text(" => "),
-                Reset(),
-                Bold(),
-                Text(dest),
-            ]
-        else:
-            components = [
-                Bold(),
-                Text(pfx),
-                Reset(),
-                LightGray(),
-                Text("{%s => %s}" % (src_mid, dest_mid)),
-                Reset(),
-                Bold(),
-                Text(sfx),
-            ]
-        return "".join(x.render({})[1] for x in components)
+            return "".join(
+                (Bold.seq, src, Reset.seq, Blue.seq, " => ", Reset.seq, Bold.seq, dest)
+            )
+        return "".join(
+            (
+                Bold.seq,
+                pfx,
+                Reset.seq,
+                LightGray.seq,
+                "{%s => %s}" % (src_mid, dest_mid),
+                Reset.seq,
+                Bold.seq,
+                sfx,
+            )
+        )
 
 
 class Counter(DynamicText):
+    def __init__(self) -> None:
+        # The format only changes with the number of digits of count
+        self.count = -1
+        self.counter_format = ""
+
     def get_text(self, props: Props) -> str:
         index = props["index"]
         count = props["count"]
-        num_digits = len(str(count))
-        counter_format = "[%{}d/%d]".format(num_digits)
-        return counter_format % (index, count)
+        if count != self.count:
+            num_digits = len(str(count))
+            self.counter_format = "[%{}d/%d]".format(num_digits)
+            self.count = count
+        return self.counter_format % (index, count)
 
 
 class Percent(DynamicText):
@@ -361,37 +410,106 @@ class FixedTuple:
     component: Component
 
 
+def is_static(component: Component) -> bool:
+    """Static components render the same string whatever the props"""
+    return isinstance(component, (AnsiEscapeSequence, Text))
+
+
 class Line:
+    """A line made of components.
+
+    The line is compiled once: consecutive static components are
+    rendered into a single string of the template, and only the
+    other components are rendered each time
+
+    """
+
     def __init__(self, components: typing.List[Component]) -> None:
         self.components = components
+        # Rendered static segments, with empty strings for
+        # the dynamic components
+        self.template: typing.List[str] = list()
+        # Dynamic components, with their index in the template
+        self.dynamic: typing.List[FixedTuple] = list()
+        self.static_width = 0
         fixed = list()
-        for i, component in enumerate(components):
+        previous_is_static = False
+        for component in components:
+            if is_static(component):
+                length, string = component.render({})
+                self.static_width += length
+                if previous_is_static:
+                    self.template[-1] += string
+                else:
+                    self.template.append(string)
+                previous_is_static = True
+                continue
+            previous_is_static = False
+            index = len(self.template)
+            self.template.append("")
             if isinstance(component, FixedWidthComponent):
-                fixed.append(FixedTuple(i, component))
+                fixed.append(FixedTuple(index, component))
+            else:
+                self.dynamic.append(FixedTuple(index, component))
         assert len(fixed) == 1, "Expecting exactly one fixed width component"
         self.fixed = fixed[0]
 
     def render(self, **kwargs: typing.Any) -> str:
-        accumulator = [""] * len(self.components)
-        term_width = shutil.get_terminal_size().columns
-        current_width = 0
-        for i, component in enumerate(self.components):
-            if i == self.fixed.index:
-                continue
-            length, string = component.render(kwargs)
-            accumulator[i] = string
+        accumulator = self.template.copy()
+        current_width = self.static_width
+        for dynamic in self.dynamic:
+            length, string = dynamic.component.render(kwargs)
+            accumulator[dynamic.index] = string
             current_width += length
 
-        fixed_width = term_width - current_width
-        kwargs["width"] = fixed_width
+        kwargs["width"] = terminal_width.get() - current_width
         accumulator[self.fixed.index] = self.fixed.component.render(kwargs)[1]
 
         return "".join(accumulator)
 
 
+# How often progress is rendered while transferring, in seconds
+REFRESH_INTERVAL = 0.1
+
+
+class Ticker:
+    """Call a function every interval seconds on a separate thread,
+    so that rendering progress never slows down the transfer itself
+
+    """
+
+    def __init__(
+        self, func: typing.Callable[[], None], interval: float = REFRESH_INTERVAL
+    ) -> None:
+        self.func = func
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.func()
+
+
+# (index, src, dest, size) of a file transferred as part of a batch
+BatchFile = typing.Tuple[int, str, str, int]
+
+
 class ProgressIndicator:
     def __init__(self) -> None:
-        pass
+        terminal_width.watch()
 
     def on_new_file(self, progress: Progress) -> None:
         pass
@@ -408,6 +526,133 @@ class ProgressIndicator:
     def on_finish(self) -> None:
         pass
 
+    def on_error(self, src: str, error: Exception) -> None:
+        pass
+
+    def on_batch(self, progress: Progress, files: typing.List[BatchFile]) -> None:
+        """Called once a batch of small files is transferred, with
+        progress describing the whole batch as one file
+
+        """
+        self.on_new_file(progress)
+        self.on_progress(progress)
+        self.on_file_done()
+
+    def on_sync(self, progress: Progress) -> None:
+        pass
+
+
+# JSON progress events are emitted at most every JSON_PROGRESS_INTERVAL seconds
+JSON_PROGRESS_INTERVAL = 1.0
+
+
+class JsonIndicator(ProgressIndicator):
+    """Emit newline-delimited JSON events, for programs
+    monitoring the transfer
+
+    """
+
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None) -> None:
+        super().__init__()
+        self.stream = stream if stream is not None else sys.stdout
+        self.start = 0.0
+        self.last_event = 0.0
+        self.errors = 0
+        self.progress: typing.Optional[Progress] = None
+
+    def emit(self, event: str, **kwargs: typing.Any) -> None:
+        kwargs["event"] = event
+        kwargs["time"] = round(time.time(), 3)
+        self.stream.write(json.dumps(kwargs) + "\n")
+        self.stream.flush()
+
+    def on_start(self) -> None:
+        self.start = time.time()
+        self.emit("start")
+
+    def on_new_file(self, progress: Progress) -> None:
+        self.progress = progress
+        self.emit(
+            "new_file",
+            index=progress.index,
+            count=progress.count,
+            src=progress.src,
+            dest=progress.dest,
+            size=progress.file_size,
+        )
+
+    def on_progress(self, progress: Progress) -> None:
+        self.progress = progress
+        now = time.time()
+        if now - self.last_event < JSON_PROGRESS_INTERVAL:
+            return
+        self.last_event = now
+        self.emit(
+            "progress",
+            index=progress.index,
+            count=progress.count,
+            src=progress.src,
+            file_done=progress.file_done,
+            file_size=progress.file_size,
+            total_done=progress.total_done,
+            total_size=progress.total_size,
+            elapsed=round(progress.total_elapsed, 3),
+        )
+
+    def on_file_done(self) -> None:
+        progress = self.progress
+        if progress is None:
+            return
+        self.emit(
+            "file_done",
+            index=progress.index,
+            src=progress.src,
+            dest=progress.dest,
+            size=progress.file_done,
+            total_done=progress.total_done,
+        )
+
+    def on_batch(self, progress: Progress, files: typing.List[BatchFile]) -> None:
+        # One pair of events per file, as if they were not batched
+        self.progress = progress
+        total_done = progress.total_done - sum(x[3] for x in files)
+        for index, src, dest, size in files:
+            total_done += size
+            self.emit(
+                "new_file",
+                index=index,
+                count=progress.count,
+                src=src,
+                dest=dest,
+                size=size,
+            )
+            self.emit(
+                "file_done",
+                index=index,
+                src=src,
+                dest=dest,
+                size=size,
+                total_done=total_done,
+            )
+
+    def on_error(self, src: str, error: Exception) -> None:
+        self.errors += 1
+        self.emit("error", src=src, message=str(error))
+
+    def on_sync(self, progress: Progress) -> None:
+        self.emit("sync", elapsed=round(progress.sync_elapsed, 3))
+
+    def on_finish(self) -> None:
+        progress = self.progress if self.progress is not None else Progress()
+        self.emit(
+            "finish",
+            count=progress.count,
+            total_done=progress.total_done,
+            total_size=progress.total_size,
+            errors=self.errors,
+            elapsed=round(time.time() - self.start, 3),
+        )
+
 
 class OneFileIndicator(ProgressIndicator):
     def __init__(self) -> None:
@@ -440,11 +685,10 @@ class OneFileIndicator(ProgressIndicator):
             src=progress.src,
             dest=progress.dest,
         )
-        print(out1)
         out2 = self.second_line.render(
             current_value=0, elapsed=0, max_value=progress.file_size
         )
-        print(out2, end="\r")
+        sys.stdout.write(out1 + "\n" + out2 + "\r")
 
     def on_progress(self, progress: Progress) -> None:
         out = self.second_line.render(
@@ -454,10 +698,13 @@ class OneFileIndicator(ProgressIndicator):
             elapsed=progress.file_elapsed,
             max_value=progress.file_size,
         )
-        print(out, end="\r")
+        sys.stdout.write(out + "\r")
 
     def on_file_done(self) -> None:
-        print()
+        sys.stdout.write("\n")
+
+    def on_sync(self, progress: Progress) -> None:
+        print("Synced to disk in %.2fs" % progress.sync_elapsed)
 
 
 class GlobalIndicator(ProgressIndicator):
@@ -517,26 +764,32 @@ class GlobalIndicator(ProgressIndicator):
             ]
         )
 
-    def _render_first_line(self, progress: Progress) -> None:
-        out = self.first_line.render(
+    def _render_first_line(self, progress: Progress) -> str:
+        return self.first_line.render(
             index=progress.index,
             count=progress.count,
             current_value=progress.total_done,
             elapsed=progress.total_elapsed,
             max_value=progress.total_size,
         )
-        cursor_up(2)
-        print("\r", out, sep="")
 
-    def _render_second_line(self, progress: Progress) -> None:
-        out = self.second_line.render(
+    def _render_second_line(self, progress: Progress) -> str:
+        return self.second_line.render(
             current_value=progress.file_done,
             max_value=progress.file_size,
             elapsed=progress.file_elapsed,
             filename=progress.src,
         )
-        print("\r", out, sep="")
 
     def on_progress(self, progress: Progress) -> None:
-        self._render_first_line(progress)
-        self._render_second_line(progress)
+        # Write the whole frame at once
+        frame = "%s\r%s\n\r%s\n" % (
+            cursor_up_sequence(2),
+            self._render_first_line(progress),
+            self._render_second_line(progress),
+        )
+        sys.stdout.write(frame)
+        sys.stdout.flush()
+
+    def on_sync(self, progress: Progress) -> None:
+        print("Synced to disk in %.2fs" % progress.sync_elapsed)
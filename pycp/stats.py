@@ -0,0 +1,148 @@
+"""This module contains the Stats class, used by --stats
+to tell where the time went during a transfer.
+
+"""
+
+import array
+import contextlib
+import heapq
+import threading
+import time
+import typing
+
+from pycp.progress import human_readable
+
+# Number of files listed in the "slowest files" section
+SLOWEST_COUNT = 10
+
+PERCENTILES = (50, 90, 99)
+
+# Phases in the order they are reported
+PHASES = (
+    "scan",
+    "rename",
+    "open",
+    "copy",
+    "small files",
+    "verify",
+    "metadata",
+    "sync",
+    "cleanup",
+)
+
+
+def format_speed(bytes_per_second: float) -> str:
+    return human_readable(int(bytes_per_second)) + "/s"
+
+
+def percentile(values: typing.Sequence[float], percent: int) -> float:
+    """values must be sorted"""
+    index = min(len(values) - 1, len(values) * percent // 100)
+    return values[index]
+
+
+class Stats:
+    """Collect timings for each phase of the transfer, and for
+    each transferred file.
+
+    Phase timings are summed over all the worker threads,
+    so with --jobs they can add up to more than the total time
+
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.phases: typing.Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.files = 0
+        self.size = 0
+        self.skipped = 0
+        self.skipped_size = 0
+        self.failed = 0
+        # Bytes per second for each file, kept compact since
+        # there can be millions of them
+        self.throughputs = array.array("d")
+        # Min-heap of (duration, size, path) of the slowest files
+        self.slowest: typing.List[typing.Tuple[float, int, str]] = list()
+
+    def add_phase(self, name: str, duration: float) -> None:
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_file(self, path: str, size: int, duration: float) -> None:
+        with self.lock:
+            self.files += 1
+            self.size += size
+            if size and duration > 0:
+                self.throughputs.append(size / duration)
+            item = (duration, size, path)
+            if len(self.slowest) < SLOWEST_COUNT:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def add_skipped(self, count: int, size: int) -> None:
+        with self.lock:
+            self.skipped += count
+            self.skipped_size += size
+
+    def add_failed(self) -> None:
+        with self.lock:
+            self.failed += 1
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.start
+
+    def report(self) -> str:
+        lines = ["Statistics:", "  Phases:"]
+        for name, duration in self.phases.items():
+            # Skip phases that did not happen at all
+            if not duration:
+                continue
+            lines.append("    %-12s %8.2fs" % (name, duration))
+        elapsed = self.elapsed or time.perf_counter() - self.start
+        lines.append(
+            "  Total: %.2fs, %d files, %s"
+            % (elapsed, self.files, human_readable(self.size))
+        )
+        if elapsed > 0:
+            lines.append(
+                "  Throughput: %s, %.1f files/s"
+                % (format_speed(self.size / elapsed), self.files / elapsed)
+            )
+        if self.throughputs:
+            throughputs = sorted(self.throughputs)
+            lines.append(
+                "  Per-file throughput: "
+                + ", ".join(
+                    "p%d %s" % (x, format_speed(percentile(throughputs, x)))
+                    for x in PERCENTILES
+                )
+            )
+        if self.slowest:
+            lines.append("  Slowest files:")
+            for duration, size, path in sorted(self.slowest, reverse=True):
+                lines.append(
+                    "    %8.2fs %8s  %s" % (duration, human_readable(size), path)
+                )
+        lines.append(
+            "  Skipped: %d files (%s), failed: %d files"
+            % (self.skipped, human_readable(self.skipped_size), self.failed)
+        )
+        return "\n".join(lines)
+
+
+def measure(stats: typing.Optional[Stats], name: str) -> typing.ContextManager[None]:
+    """Time the phase called name, if stats are collected"""
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
@@ -0,0 +1,113 @@
+"""This module contains the Syncer class, used by --sync to
+make sure the transferred files are on disk once pycp exits.
+
+"""
+
+import os
+import threading
+import time
+import typing
+
+from pycp.engine import datasync, fsync_path, syncfs
+
+# Values of --sync:
+# * none: leave it to the kernel
+# * file: flush the data of each file before closing it
+# * end: flush the destination filesystem once, at the end
+# * dir: flush the files of a directory together, once the
+#   transfer moves on to an other directory
+POLICIES = ("none", "file", "end", "dir")
+
+
+class Syncer:
+    """Flush the transferred files to disk, according to
+    a --sync policy, and measure the time spent doing so.
+
+    The directories containing new files are flushed too,
+    so that the new files can be found after a crash
+
+    """
+
+    def __init__(self, policy: str = "none") -> None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown sync policy: %s" % policy)
+        self.policy = policy
+        # Protects everything below, since worker threads
+        # report their files concurrently
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+        # With "file", directories of the files, to flush at the end
+        self.directories: typing.Set[str] = set()
+        # With "dir", the files of current_dir not flushed yet
+        self.current_dir: typing.Optional[str] = None
+        self.pending: typing.List[str] = list()
+
+    def sync_file(self, fd: int) -> None:
+        """Called with each destination file, once its data
+        is written but before it is closed
+
+        """
+        if self.policy != "file":
+            return
+        start = time.perf_counter()
+        datasync(fd)
+        self._add_time(start)
+
+    def add(self, dest: str) -> None:
+        """Called once dest is complete, metadata included"""
+        if self.policy == "file":
+            with self.lock:
+                self.directories.add(os.path.dirname(os.path.abspath(dest)))
+            return
+        if self.policy != "dir":
+            return
+        directory = os.path.dirname(dest)
+        flushed_dir: typing.Optional[str] = None
+        to_flush: typing.List[str] = list()
+        with self.lock:
+            if directory != self.current_dir:
+                flushed_dir = self.current_dir
+                to_flush, self.pending = self.pending, list()
+                self.current_dir = directory
+            self.pending.append(dest)
+        if flushed_dir is not None and to_flush:
+            self._flush(flushed_dir, to_flush)
+
+    def finish(self, destination: str, created_dirs: typing.Iterable[str] = ()) -> None:
+        """Flush what is left, destination being a path on
+        the destination filesystem.
+
+        created_dirs are the directories created by the transfer:
+        their parents are flushed too, so that they can be found
+        after a crash
+
+        """
+        if self.policy == "dir" and self.current_dir is not None:
+            self._flush(self.current_dir, self.pending)
+            self.current_dir = None
+            self.pending = list()
+        start = time.perf_counter()
+        if self.policy == "end":
+            syncfs(destination)
+        elif self.policy in ("file", "dir"):
+            directories = self.directories.union(
+                os.path.dirname(os.path.abspath(x)) for x in created_dirs
+            )
+            # Children first
+            for directory in sorted(directories, reverse=True):
+                fsync_path(directory)
+            self.directories.clear()
+        self._add_time(start)
+
+    def _flush(self, directory: str, files: typing.List[str]) -> None:
+        start = time.perf_counter()
+        for path in files:
+            # Metadata was set after the data was written, so
+            # fdatasync() would not be enough here
+            fsync_path(path)
+        fsync_path(directory)
+        self._add_time(start)
+
+    def _add_time(self, start: float) -> None:
+        with self.lock:
+            self.elapsed += time.perf_counter() - start
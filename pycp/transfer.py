@@ -6,14 +6,66 @@ pycp.progress
 
 """
 
+import collections
+import errno
 import os
+import queue
 import stat
+import sys
+import threading
 import time
 import typing
-
-from pycp.progress import GlobalIndicator, OneFileIndicator, Progress, ProgressIndicator
-
-BUFFER_SIZE = 100 * 1024
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pycp.checksum import Hasher, ManifestEntry, file_digest, write_manifest
+from pycp.dedupe import DuplicateFinder
+from pycp.engine import (
+    DIRECT_CHUNK_SIZE,
+    Callback,
+    DataCallback,
+    DirectIOUnsupported,
+    PageCacheDropper,
+    ReflinkUnsupported,
+    can_reflink,
+    copy_data,
+    copy_sparse,
+    delta_copy,
+    direct_copy,
+    has_holes,
+    preallocate,
+    reflink,
+    same_data,
+    write_all,
+)
+from pycp.progress import (
+    BatchFile,
+    GlobalIndicator,
+    JsonIndicator,
+    OneFileIndicator,
+    Progress,
+    ProgressIndicator,
+    Ticker,
+    human_readable,
+)
+from pycp.stats import Stats, measure
+from pycp.sync import Syncer
+from pycp.transfer_list import Entry, TransferList
+
+# Maximum number of files waiting to be transferred when streaming
+STREAM_QUEUE_SIZE = 1024
+
+# Smaller files are not worth a posix_fallocate() call
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+# Regular files smaller than this are copied with a single
+# read() and write(), and their progress is reported by batches
+# of at most SMALL_FILES_PER_BATCH files
+SMALL_FILE_SIZE = 64 * 1024
+SMALL_FILES_PER_BATCH = 100
+
+# With --resume, how many bytes before the end of a partial
+# destination must match the source
+RESUME_CHECK_SIZE = 1024 * 1024
 
 
 class TransferError(Exception):
@@ -27,6 +79,13 @@ class TransferError(Exception):
         return self.message
 
 
+class TransferInterrupted(Exception):
+    """Raised in the worker threads to stop the transfers
+    in progress when the whole transfer is interrupted
+
+    """
+
+
 class TransferOptions:
     def __init__(self) -> None:
         self.ignore_errors = False
@@ -35,6 +94,39 @@ class TransferOptions:
         self.preserve = False
         self.safe = False
         self.move = False
+        self.reflink = "auto"
+        self.jobs = 1
+        self.stream = False
+        # Size of the chunks copied in userspace, None means auto
+        self.buffer_size: typing.Optional[int] = None
+        self.sparse = "auto"
+        self.nocache = False
+        self.direct = False
+        # None, "mtime" or "ctime", see is_up_to_date()
+        self.skip_unchanged: typing.Optional[str] = None
+        self.resume = False
+        self.delta = False
+        # Name of the hashlib algorithm used to check copies, if any
+        self.verify: typing.Optional[str] = None
+        # Where to write the checksums of the copied files
+        self.manifest: typing.Optional[str] = None
+        # "bar", "json", "none", or "auto" for bars only when
+        # stdout is a terminal
+        self.progress = "bar"
+        # Where to write JSON progress events, stdout if None
+        self.progress_fd: typing.Optional[int] = None
+        # Collect timings for the report printed by --stats
+        self.stats = False
+        # Transfer files with several hard links once, and
+        # link the other paths to the copy
+        self.preserve_links = False
+        # None, or how to create files with the same contents as
+        # an other file of the transfer: "reflink" or "link"
+        self.dedupe: typing.Optional[str] = None
+        # When to flush the transferred files to disk, see pycp.sync
+        self.sync = "none"
+        # Refuse to start transfers that cannot fit on the destination
+        self.check_space = True
 
     def update(self, args: typing.Dict[str, typing.Any]) -> None:
         for name, value in vars(args).items():
@@ -53,11 +145,278 @@ def samefile(src: str, dest: str) -> bool:
         return False
 
 
+def same_device(src_st: os.stat_result, dest: str) -> bool:
+    """Check if dest would be created on the same device
+    as the file described by src_st, so that it can simply be renamed
+
+    """
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    try:
+        return src_st.st_dev == os.stat(dest_dir).st_dev
+    except OSError:
+        return False
+
+
+def stat_or_none(path: str) -> typing.Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def lstat_or_none(path: str) -> typing.Optional[os.stat_result]:
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def is_up_to_date(
+    src_st: os.stat_result, dest_st: os.stat_result, compare: str
+) -> bool:
+    """Check if a destination with dest_st can be kept as is
+
+    It has to be of the same type and size as the source, and not
+    older than the last modification of the source.
+    When compare is "ctime", the source inode must also not have
+    changed since the destination was last written, which catches
+    files whose mtime was set back.
+
+    """
+    if stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dest_st.st_mode):
+        return False
+    if src_st.st_size != dest_st.st_size:
+        return False
+    if dest_st.st_mtime_ns < src_st.st_mtime_ns:
+        return False
+    if compare == "ctime" and dest_st.st_ctime_ns < src_st.st_ctime_ns:
+        return False
+    return True
+
+
+def allocated_size(st: os.stat_result) -> int:
+    """Return the size of the data actually stored for a file,
+    which is less than its size when it has holes
+
+    """
+    blocks: typing.Optional[int] = getattr(st, "st_blocks", None)
+    if blocks is None:
+        return st.st_size
+    return min(st.st_size, blocks * 512)
+
+
 def check_same_file(src: str, dest: str) -> None:
     if samefile(src, dest):
         raise TransferError("%s and %s are the same file!" % (src, dest))
 
 
+def message_stream(options: TransferOptions) -> typing.TextIO:
+    """Return where to print messages for the user: stderr when
+    stdout carries the JSON progress events
+
+    """
+    if options.progress == "json" and options.progress_fd is None:
+        return sys.stderr
+    return sys.stdout
+
+
+def skip_existing(dest: str, options: TransferOptions) -> bool:
+    """Return True if the existing dest should be left alone.
+    Ask user for confirmation if we were called
+    with an 'interactive' option.
+
+    """
+    # Safe: always skip
+    if options.safe:
+        print("Waning: skipping", dest, file=message_stream(options))
+        return True
+
+    # Not safe and not interactive => overwrite
+    if not options.interactive:
+        return False
+
+    # Interactive
+    out = message_stream(options)
+    print("File: '%s' already exists" % dest, file=out)
+    print("Overwrite?", file=out)
+    user_input = input()
+    if user_input == "y":
+        return False
+    else:
+        return True
+
+
+def can_copy_small_files(options: TransferOptions) -> bool:
+    """Check if small files can take the fast path of
+    copy_small_file() with these options
+
+    """
+    return not (
+        options.move
+        or options.interactive
+        or options.resume
+        or options.delta
+        or options.verify
+        or options.nocache
+        or options.direct
+        or options.reflink == "always"
+        or options.sparse == "always"
+        # Flushing each file costs much more than what the fast path saves
+        or options.sync == "file"
+    )
+
+
+def copy_small_file(
+    src: str, dest: str, src_st: os.stat_result, options: TransferOptions
+) -> bool:
+    """Copy a small regular file with as few syscalls as possible:
+    no stat() on dest, one read() and one write(), and metadata
+    set using the file descriptors.
+
+    Return False if dest was skipped because it already exists
+    and the 'safe' option is set
+
+    """
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+    except OSError:
+        raise TransferError("Could not open %s for reading" % src)
+    try:
+        flags = os.O_WRONLY | os.O_CREAT
+        if options.safe:
+            flags |= os.O_EXCL
+        try:
+            dest_fd = os.open(dest, flags, 0o600)
+        except FileExistsError:
+            print("Waning: skipping", dest, file=message_stream(options))
+            return False
+        except OSError:
+            raise TransferError("Could not open %s for writing" % dest)
+        try:
+            copy_small_file_data(src, dest, src_fd, dest_fd, src_st, options)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    return True
+
+
+def copy_small_file_data(
+    src: str,
+    dest: str,
+    src_fd: int,
+    dest_fd: int,
+    src_st: os.stat_result,
+    options: TransferOptions,
+) -> None:
+    # dest is not truncated when opened, in case it is src itself
+    dest_st = os.fstat(dest_fd)
+    if (dest_st.st_dev, dest_st.st_ino) == (src_st.st_dev, src_st.st_ino):
+        raise TransferError("%s and %s are the same file!" % (src, dest))
+    try:
+        if dest_st.st_size:
+            os.ftruncate(dest_fd, 0)
+        data = os.read(src_fd, SMALL_FILE_SIZE)
+        write_all(dest_fd, memoryview(data))
+        if len(data) == SMALL_FILE_SIZE:
+            # The file grew since the scan
+            copy_data(src_fd, dest_fd, lambda _: None)
+    except OSError as err:
+        mess = "Problem when transferring %s to %s\n" % (src, dest)
+        mess += "Error was: %s" % err
+        raise TransferError(mess)
+
+    try:
+        os.fchmod(dest_fd, stat.S_IMODE(src_st.st_mode))
+        if options.preserve:
+            os.utime(dest_fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+    except OSError as err:
+        mess = "Warning: failed to finalize transfer of %s: %s" % (dest, err)
+        print(mess, file=message_stream(options))
+        return
+    if options.preserve:
+        try:
+            os.fchown(dest_fd, src_st.st_uid, src_st.st_gid)
+        except OSError:
+            # Same as FileTransferManager.post_transfer()
+            pass
+
+
+def is_partial_copy(src_fd: int, dest_fd: int, src_size: int, dest_size: int) -> bool:
+    """Check if dest is no larger than src, and if the end of
+    what it contains matches src, so that the copy can be resumed
+
+    """
+    check_size = min(dest_size, RESUME_CHECK_SIZE)
+    return 0 < dest_size <= src_size and same_data(
+        src_fd, dest_fd, dest_size - check_size, check_size
+    )
+
+
+def link_file(target: str, dest: str, options: TransferOptions) -> bool:
+    """Make dest a hard link to target, replacing any
+    existing dest depending on the 'safe' and 'interactive' options
+
+    Return False if dest was left alone
+
+    """
+    if lstat_or_none(dest) is not None:
+        if samefile(target, dest):
+            return True
+        if skip_existing(dest, options):
+            return False
+        os.remove(dest)
+    os.link(target, dest)
+    return True
+
+
+def clone_file(
+    target: str, dest: str, src_st: os.stat_result, options: TransferOptions
+) -> bool:
+    """Make dest share the data of target, which has the same
+    contents as the file described by src_st, then give it the
+    metadata of src_st.
+
+    An existing dest is replaced depending on the 'safe' and
+    'interactive' options: return False if it was left alone.
+
+    Raise ReflinkUnsupported if target cannot be cloned, in which
+    case dest is left alone too
+
+    """
+    if lstat_or_none(dest) is not None:
+        if samefile(target, dest):
+            return True
+        if skip_existing(dest, options):
+            return False
+    with open(target, "rb") as target_file, open(dest, "wb") as dest_file:
+        dest_fd = dest_file.fileno()
+        try:
+            reflink(target_file.fileno(), dest_fd)
+        except ReflinkUnsupported:
+            os.remove(dest)
+            raise
+        os.fchmod(dest_fd, stat.S_IMODE(src_st.st_mode))
+        if options.preserve:
+            os.utime(dest_fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+            try:
+                os.fchown(dest_fd, src_st.st_uid, src_st.st_gid)
+            except OSError:
+                # Same as FileTransferManager.post_transfer()
+                pass
+    return True
+
+
+def sync_dest(syncer: typing.Optional[Syncer], dest: str) -> None:
+    """Tell syncer that dest is complete"""
+    if syncer is None:
+        return
+    try:
+        syncer.add(dest)
+    except OSError as err:
+        raise TransferError("Could not sync %s: %s" % (dest, err))
+
+
 def handle_symlink(src: str, dest: str) -> None:
     target = os.readlink(src)
     # remove existing stuff
@@ -66,36 +425,124 @@ def handle_symlink(src: str, dest: str) -> None:
     os.symlink(target, dest)
 
 
-def open_files(src: str, dest: str) -> typing.Tuple[typing.BinaryIO, typing.BinaryIO]:
+def open_files(
+    src: str, dest: str, keep_dest: bool = False
+) -> typing.Tuple[typing.BinaryIO, typing.BinaryIO]:
+    """Open src for reading and dest for writing.
+
+    If keep_dest is True, dest must exist and is not truncated
+
+    """
     try:
         src_file = open(src, "rb")
     except IOError:
         raise TransferError("Could not open %s for reading" % src)
     try:
-        dest_file = open(dest, "wb")
+        dest_file = open(dest, "r+b" if keep_dest else "wb")
     except IOError:
         raise TransferError("Could not open %s for writing" % dest)
     return src_file, dest_file
 
 
+# What the scanning thread sends when streaming
+ScanItem = typing.Union[Entry, Exception]
+
+
+def put_unless_stopped(
+    entries: "queue.Queue[typing.Optional[ScanItem]]",
+    item: typing.Optional[ScanItem],
+    stop: threading.Event,
+) -> None:
+    """Wait for room in entries, giving up once stop is set"""
+    while not stop.is_set():
+        try:
+            entries.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
 class TransferInfo:
     """This class contains:
-    * a list of tuples: to_transfer (src, dest) where:
+    * a TransferList: to_transfer of Entry(src, dest, st) where:
        - src and dest are both files
        - basename(dest) is guaranteed to exist)
     * an add(src, dest) method
     * a get_size() which is the total size of the files to be
     transferred
+    * when moving, a list of tuples: to_rename (src, dest) of
+    whole directories that can be renamed instead of being transferred
+    * when skip_unchanged is set, the number and size of the
+    files skipped because their destination is up to date
+    * scan_time: the time spent walking the sources
+    * when preserve_links is set, a list of tuples: to_link
+    (src, target, dest) of files that are hard links to a file
+    already in to_transfer, whose destination is target
+    * when dedupe is set, a list of tuples: to_dedupe (entry, target)
+    of files with the same contents as a file already in to_transfer,
+    whose destination is target, and the total size of those files
+    * when in_place is set, in_place_size: the size of the data of
+    existing destinations that will be rewritten in place
+    * space_by_device: the space the copies of the files will need,
+    by device of the sources. When sparse is set, holes are preserved
+    and need no space
+
+    When streaming, to_transfer stays empty: the files are
+    yielded by stream() instead, while size and count are
+    refined as the walk proceeds.
 
     """
 
-    def __init__(self, sources: typing.List[str], destination: str) -> None:
+    def __init__(
+        self,
+        sources: typing.List[str],
+        destination: str,
+        move: bool = False,
+        streaming: bool = False,
+        skip_unchanged: typing.Optional[str] = None,
+        preserve_links: bool = False,
+        dedupe: bool = False,
+        in_place: bool = False,
+        sparse: bool = False,
+    ) -> None:
+        self.sources = sources
+        self.destination = destination
+        self.skip_unchanged = skip_unchanged
         self.size = 0
-        # List of tuples (src, dest, size) of files to transfer
-        self.to_transfer: typing.List[typing.Tuple[str, str, int]] = list()
+        self.sparse = sparse
+        # Space needed by the copies of the files, by st_dev
+        self.space_by_device: typing.Dict[int, int] = collections.defaultdict(int)
+        # Number of files found so far
+        self.count = 0
+        self.move = move
+        # Files to transfer
+        self.to_transfer = TransferList()
         # List of directories to remove
         self.to_remove: typing.List[str] = list()
-        self.parse(sources, destination)
+        # List of tuples (src, dest) of directories to rename
+        self.to_rename: typing.List[typing.Tuple[str, str]] = list()
+        # Destination directories created or renamed so far
+        self.created_dirs: typing.List[str] = list()
+        # Files left alone because their destination is up to date
+        self.skipped = 0
+        self.skipped_size = 0
+        self.preserve_links = preserve_links
+        # Destination of the first link found, by (st_dev, st_ino)
+        self.first_links: typing.Dict[typing.Tuple[int, int], str] = dict()
+        # List of tuples (src, target, dest) of links to create
+        self.to_link: typing.List[typing.Tuple[str, str, str]] = list()
+        self.duplicate_finder = DuplicateFinder() if dedupe else None
+        self.to_dedupe: typing.List[typing.Tuple[Entry, str]] = list()
+        self.dedupe_size = 0
+        self.in_place = in_place
+        # Size of the data of existing destinations that will be
+        # updated in place, and needs no free space
+        self.in_place_size = 0
+        # Not counting the time spent waiting for the consumer
+        # of the entries, when streaming
+        self.scan_time = 0.0
+        if not streaming:
+            self.parse(sources, destination)
 
     def parse(self, sources: typing.List[str], destination: str) -> None:
         """Recursively go through the sources, creating missing
@@ -103,53 +550,244 @@ class TransferInfo:
         so on.
 
         """
-        filenames = [x for x in sources if os.path.isfile(x)]
-        directories = [x for x in sources if os.path.isdir(x)]
+        self.to_transfer.extend(self._timed(self.walk(sources, destination)))
+
+    def _timed(self, entries: typing.Iterator[Entry]) -> typing.Iterator[Entry]:
+        """Yield entries, adding the time spent producing them
+        to scan_time
+
+        """
+        start = time.perf_counter()
+        for entry in entries:
+            self.scan_time += time.perf_counter() - start
+            yield entry
+            start = time.perf_counter()
+        self.scan_time += time.perf_counter() - start
+
+    def stream(self, queue_size: int = STREAM_QUEUE_SIZE) -> typing.Iterator[Entry]:
+        """Walk the sources on a separate thread, yielding
+        files as soon as they are found.
+
+        At most queue_size files are waiting to be transferred
+        at any given time.
+
+        """
+        entries: "queue.Queue[typing.Optional[ScanItem]]" = queue.Queue(queue_size)
+        stop = threading.Event()
+
+        producer = threading.Thread(
+            target=self._produce, args=(entries, stop), daemon=True
+        )
+        producer.start()
+        try:
+            while True:
+                item = entries.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def _produce(
+        self,
+        entries: "queue.Queue[typing.Optional[ScanItem]]",
+        stop: threading.Event,
+    ) -> None:
+        """Run by the producer thread of stream(): put the files
+        in entries, then the error that stopped the walk if any,
+        then None
 
-        for filename in filenames:
-            self._parse_file(filename, destination)
+        """
+        try:
+            for entry in self._timed(self.walk(self.sources, self.destination)):
+                put_unless_stopped(entries, entry, stop)
+                if stop.is_set():
+                    return
+        except Exception as error:
+            put_unless_stopped(entries, error, stop)
+        # Tell the consumer we are done
+        put_unless_stopped(entries, None, stop)
+
+    def walk(
+        self, sources: typing.List[str], destination: str
+    ) -> typing.Iterator[Entry]:
+        """Same as parse(), but yield the files to transfer"""
+        files = list()
+        directories = list()
+        for source in sources:
+            try:
+                st = os.lstat(source)
+                # Symlinks to directories are followed
+                target_st = os.stat(source) if stat.S_ISLNK(st.st_mode) else st
+            except OSError:
+                continue
+            if stat.S_ISDIR(target_st.st_mode):
+                directories.append(source)
+            elif stat.S_ISREG(target_st.st_mode):
+                files.append((source, st))
+        yield from self._walk(files, directories, destination)
+
+    def _walk(
+        self,
+        files: typing.List[typing.Tuple[str, os.stat_result]],
+        directories: typing.List[str],
+        destination: str,
+    ) -> typing.Iterator[Entry]:
+        dest_is_dir = os.path.isdir(destination)
+
+        for filename, st in files:
+            entry = self._parse_file(filename, st, destination, dest_is_dir)
+            if entry:
+                yield entry
 
         for directory in directories:
-            self._parse_dir(directory, destination)
+            yield from self._parse_dir(directory, destination, dest_is_dir)
+
+    def _parse_file(
+        self, source: str, st: os.stat_result, destination: str, dest_is_dir: bool
+    ) -> typing.Optional[Entry]:
+        """Parse a new source file, returning None if
+        it does not need to be transferred
 
-    def _parse_file(self, source: str, destination: str) -> None:
-        """Parse a new source file"""
-        if os.path.isdir(destination):
+        """
+        if dest_is_dir:
             basename = os.path.basename(os.path.normpath(source))
             destination = os.path.join(destination, basename)
-        self.add(source, destination)
-
-    def _parse_dir(self, source: str, destination: str) -> None:
+        if self.preserve_links and st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+            target = self.first_links.setdefault((st.st_dev, st.st_ino), destination)
+            if target != destination:
+                # Its data is only transferred, and counted, once
+                self.to_link.append((source, target, destination))
+                return None
+        compare = self.skip_unchanged
+        dest_st = None
+        if compare or self.in_place:
+            dest_st = lstat_or_none(destination)
+        if compare:
+            if dest_st and is_up_to_date(st, dest_st, compare):
+                self.skipped += 1
+                self.skipped_size += st.st_size
+                return None
+        finder = self.duplicate_finder
+        if finder and st.st_size and stat.S_ISREG(st.st_mode):
+            original = finder.find(source, destination, st.st_size)
+            if original:
+                self.to_dedupe.append((Entry(source, destination, st), original))
+                self.dedupe_size += st.st_size
+                return None
+        if dest_st and self.in_place and stat.S_ISREG(dest_st.st_mode):
+            # What dest already contains is rewritten in place
+            self.in_place_size += min(dest_st.st_size, st.st_size)
+        return self.add(source, destination, st)
+
+    def _parse_dir(
+        self, source: str, destination: str, dest_is_dir: bool
+    ) -> typing.Iterator[Entry]:
         """Parse a new source directory"""
-        if os.path.isdir(destination):
+        if dest_is_dir:
             basename = os.path.basename(os.path.normpath(source))
             destination = os.path.join(destination, basename)
-        if not os.path.exists(destination):
+        if (
+            self.move
+            and not os.path.lexists(destination)
+            and same_device(os.lstat(source), destination)
+        ):
+            self.to_rename.append((source, destination))
+            return
+        yield from self.walk_dir_contents(source, destination)
+
+    def parse_dir_contents(self, source: str, destination: str) -> None:
+        """Parse the contents of a source directory, creating
+        the destination directory if needed
+
+        """
+        entries = self.walk_dir_contents(source, destination)
+        self.to_transfer.extend(self._timed(entries))
+
+    def walk_dir_contents(
+        self, source: str, destination: str
+    ) -> typing.Iterator[Entry]:
+        """Same as parse_dir_contents(), but yield the files to transfer"""
+        try:
             os.mkdir(destination)
-        file_names = sorted(os.listdir(source))
-        file_names = [os.path.join(source, f) for f in file_names]
-        self.parse(file_names, destination)
+            self.created_dirs.append(destination)
+        except FileExistsError:
+            pass
+        with os.scandir(source) as it:
+            dir_entries = sorted(it, key=lambda x: x.name)
+        files = list()
+        directories = list()
+        # Thanks to d_type, this only costs one lstat() per file,
+        # and none per directory
+        for dir_entry in dir_entries:
+            if dir_entry.is_dir(follow_symlinks=False):
+                directories.append(dir_entry.path)
+                continue
+            is_symlink = dir_entry.is_symlink()
+            if is_symlink and dir_entry.is_dir():
+                directories.append(dir_entry.path)
+            elif dir_entry.is_file():
+                files.append((dir_entry.path, dir_entry.stat(follow_symlinks=False)))
+        yield from self._walk(files, directories, destination)
         self.to_remove.append(source)
 
-    def add(self, src: str, dest: str) -> None:
-        """Add a new tuple to the transfer list."""
-        file_size = os.path.getsize(src)
-        if not os.path.islink(src):
-            self.size += file_size
-        self.to_transfer.append((src, dest, file_size))
-
+    def add(
+        self, src: str, dest: str, st: typing.Optional[os.stat_result] = None
+    ) -> Entry:
+        """Account for a new file to transfer, and return
+        the corresponding entry for the transfer list.
 
-Callback = typing.Callable[[int], None]
+        """
+        if st is None:
+            st = os.lstat(src)
+        entry = Entry(src, dest, st)
+        self.size += entry.size
+        space = entry.size
+        if self.sparse and space:
+            space = allocated_size(st)
+        self.space_by_device[st.st_dev] += space
+        self.count += 1
+        return entry
 
 
 class FileTransferManager:
     """This class handles transferring one file to an other"""
 
-    def __init__(self, src: str, dest: str, options: TransferOptions) -> None:
+    def __init__(
+        self,
+        src: str,
+        dest: str,
+        options: TransferOptions,
+        src_st: typing.Optional[os.stat_result] = None,
+        stats: typing.Optional[Stats] = None,
+        syncer: typing.Optional[Syncer] = None,
+    ) -> None:
         self.src = src
         self.dest = dest
         self.options = options
+        # Result of lstat() on src, usually already known
+        # from the scan
+        self.src_st = src_st if src_st is not None else os.lstat(src)
+        self.dest_st = stat_or_none(dest)
         self.callback: Callback = lambda _: None
+        # With --delta, number of bytes of dest that were compared,
+        # and that actually had to be written
+        self.delta_scanned = 0
+        self.delta_written = 0
+        # With --verify, hashes the data of src as it is copied, and
+        # the hex digest of dest once checked
+        self.src_hasher: typing.Optional[Hasher] = None
+        self.digest: typing.Optional[str] = None
+        # With --stats, where the time spent in each phase goes
+        self.stats = stats
+        # With --sync, flushes dest to disk
+        self.syncer = syncer
+        # Set when dest was left alone by handle_overwrite()
+        self.skipped = False
+        self.overwrite_checked = False
 
     def set_callback(self, callback: Callback) -> None:
         self.callback = callback
@@ -163,18 +801,15 @@ class FileTransferManager:
 
         """
         error = None
-        # Handle overwriting of files:
-        if os.path.exists(self.dest):
-            should_skip = self.handle_overwrite()
-            if should_skip:
-                return None
+        if self.should_skip():
+            return None
         try:
             self.transfer_file()
         except TransferError as exception:
             if self.options.ignore_errors:
                 error = exception
-                # remove dest file
-                if not self.options.move:
+                # remove dest file, unless we can resume from it later
+                if not self.options.move and not self.options.resume:
                     try:
                         os.remove(self.dest)
                     except OSError:
@@ -186,6 +821,22 @@ class FileTransferManager:
                 raise
         return error
 
+    def should_skip(self) -> bool:
+        """Handle overwriting of files, returning True if dest
+        must be left alone. The user is asked at most once
+
+        """
+        if self.overwrite_checked:
+            return self.skipped
+        self.overwrite_checked = True
+        # When resuming, existing files that look like an
+        # interrupted copy of src are not overwritten
+        if self.dest_st is not None and not (
+            self.options.resume and self.dest_is_partial_copy()
+        ):
+            self.skipped = self.handle_overwrite()
+        return self.skipped
+
     def transfer_file(self) -> None:
         """Transfer src to dest, calling
         callback(transferred) while doing so,
@@ -195,23 +846,29 @@ class FileTransferManager:
 
         If move is True, remove src when done.
         """
-        check_same_file(self.src, self.dest)
-        if os.path.islink(self.src):
-            handle_symlink(self.src, self.dest)
+        stats = self.stats
+        self.check_same_file()
+        if self.options.move:
+            with measure(stats, "rename"):
+                renamed = self.rename_file()
+            if renamed:
+                sync_dest(self.syncer, self.dest)
+                return
+        if stat.S_ISLNK(self.src_st.st_mode):
+            with measure(stats, "metadata"):
+                handle_symlink(self.src, self.dest)
             self.callback(0)
             return
 
-        src_file, dest_file = open_files(self.src, self.dest)
-        transferred = 0
+        resume = self.options.resume and self.dest_st is not None
+        delta = self.options.delta and self.dest_st is not None
+        with measure(stats, "open"):
+            src_file, dest_file = open_files(
+                self.src, self.dest, keep_dest=resume or delta
+            )
         try:
-            while True:
-                data = src_file.read(BUFFER_SIZE)
-                if not data:
-                    self.callback(0)
-                    break
-                transferred = len(data)
-                self.callback(transferred)
-                dest_file.write(data)
+            with measure(stats, "copy"):
+                self.write_dest(src_file, dest_file, resume, delta)
         except IOError as err:
             mess = "Problem when transferring %s to %s\n" % (self.src, self.dest)
             mess += "Error was: %s" % err
@@ -219,17 +876,247 @@ class FileTransferManager:
         finally:
             src_file.close()
             dest_file.close()
+            if self.src_hasher:
+                self.src_hasher.close()
+
+        if self.options.verify:
+            with measure(stats, "verify"):
+                self.verify(self.options.verify)
 
         try:
-            self.post_transfer()
+            with measure(stats, "metadata"):
+                self.post_transfer()
         except OSError as err:
-            print("Warning: failed to finalize transfer of %s: %s" % (self.dest, err))
+            mess = "Warning: failed to finalize transfer of %s: %s" % (self.dest, err)
+            print(mess, file=message_stream(self.options))
+        sync_dest(self.syncer, self.dest)
 
         if self.options.move:
             try:
-                os.remove(self.src)
+                with measure(stats, "cleanup"):
+                    os.remove(self.src)
             except OSError:
-                print("Warting: could not remove %s" % self.src)
+                out = message_stream(self.options)
+                print("Warting: could not remove %s" % self.src, file=out)
+
+    def write_dest(
+        self,
+        src_file: typing.BinaryIO,
+        dest_file: typing.BinaryIO,
+        resume: bool,
+        delta: bool,
+    ) -> None:
+        """Write the data of src_file into dest_file, with the
+        first method that applies: delta transfer, resuming a
+        partial copy, cloning, and a plain copy otherwise
+
+        """
+        src_fd, dest_fd = src_file.fileno(), dest_file.fileno()
+        if delta:
+            self.delta_file(src_fd, dest_fd)
+        elif not (resume and self.resume_file(src_fd, dest_fd)):
+            if not self.clone_file(src_file, dest_file):
+                self.copy_file_data(src_fd, dest_fd)
+        self.callback(0)
+        if self.options.verify:
+            # So that verify() reads the data from the disk
+            os.fsync(dest_fd)
+        elif self.syncer:
+            self.syncer.sync_file(dest_fd)
+
+    def check_same_file(self) -> None:
+        if stat.S_ISLNK(self.src_st.st_mode):
+            # Compare the targets of the links
+            check_same_file(self.src, self.dest)
+            return
+        dest_st = self.dest_st
+        if dest_st is None:
+            return
+        if (dest_st.st_dev, dest_st.st_ino) == (self.src_st.st_dev, self.src_st.st_ino):
+            raise TransferError("%s and %s are the same file!" % (self.src, self.dest))
+
+    def rename_file(self) -> bool:
+        """Try to move src to dest with a simple rename.
+
+        Return True if src was renamed, False if it is on
+        an other device and must be copied then removed instead
+
+        """
+        src_st = self.src_st
+        if not same_device(src_st, self.dest):
+            return False
+        try:
+            os.rename(self.src, self.dest)
+        except OSError as err:
+            if err.errno == errno.EXDEV:
+                return False
+            mess = "Could not rename %s to %s: %s" % (self.src, self.dest, err)
+            raise TransferError(mess)
+        if not stat.S_ISLNK(src_st.st_mode):
+            self.callback(src_st.st_size)
+        self.callback(0)
+        return True
+
+    def resume_file(self, src_fd: int, dest_fd: int) -> bool:
+        """Finish the copy of src to dest after an interruption.
+
+        The end of what dest already contains must match src.
+        Otherwise, dest is truncated and False is returned, so
+        that src is copied from the start
+
+        """
+        assert self.dest_st is not None
+        offset = self.dest_st.st_size
+        if not is_partial_copy(src_fd, dest_fd, self.src_st.st_size, offset):
+            os.ftruncate(dest_fd, 0)
+            return False
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+        # So that progress starts at the resumed position
+        self.callback(offset)
+        copy_data(src_fd, dest_fd, self.callback, buffer_size=self.options.buffer_size)
+        return True
+
+    def dest_is_partial_copy(self) -> bool:
+        """Check if the existing dest looks like an interrupted
+        copy of src, see is_partial_copy()
+
+        """
+        assert self.dest_st is not None
+        try:
+            with open(self.src, "rb") as src_file, open(self.dest, "rb") as dest_file:
+                return is_partial_copy(
+                    src_file.fileno(),
+                    dest_file.fileno(),
+                    self.src_st.st_size,
+                    self.dest_st.st_size,
+                )
+        except OSError:
+            return False
+
+    def delta_file(self, src_fd: int, dest_fd: int) -> None:
+        """Update the existing dest in place, only writing
+        the blocks that differ from src
+
+        """
+        self.delta_written = delta_copy(
+            src_fd, dest_fd, self.callback, on_data=self.hash_source()
+        )
+        self.delta_scanned = os.lseek(src_fd, 0, os.SEEK_CUR)
+
+    def clone_file(self, src_file: typing.BinaryIO, dest_file: typing.BinaryIO) -> bool:
+        """Try to clone src_file into dest_file, depending on the
+        'reflink' option.
+
+        Return True if the whole file was cloned, False if
+        its data should be copied instead
+
+        """
+        if self.options.reflink == "never":
+            return False
+        try:
+            reflink(src_file.fileno(), dest_file.fileno())
+        except ReflinkUnsupported as err:
+            if self.options.reflink == "always":
+                mess = "Could not clone %s to %s: %s" % (self.src, self.dest, err)
+                raise TransferError(mess)
+            return False
+        self.callback(self.src_st.st_size)
+        return True
+
+    def copy_file_data(self, src_fd: int, dest_fd: int) -> None:
+        """Copy the contents of src to dest, making a sparse
+        copy depending on the 'sparse' option, and sparing the page
+        cache depending on the 'nocache' and 'direct' options
+
+        """
+        sparse = self.options.sparse
+        size = self.src_st.st_size
+        buffer_size = self.options.buffer_size
+        callback = self.callback
+        cache_dropper = None
+        if self.options.nocache:
+            cache_dropper = PageCacheDropper(src_fd, dest_fd)
+            callback = cache_dropper.wrap(callback)
+
+        if sparse == "always" or (sparse == "auto" and has_holes(src_fd, size)):
+            copy_sparse(
+                src_fd,
+                dest_fd,
+                size,
+                callback,
+                buffer_size=buffer_size,
+                skip_zeros=sparse == "always",
+                on_data=self.hash_source(),
+            )
+        else:
+            # With --resume, the size of a partial destination must
+            # match the amount of data actually copied
+            preallocated = (
+                not self.options.resume
+                and size >= PREALLOCATE_MIN_SIZE
+                and preallocate(dest_fd, size)
+            )
+            direct = self.options.direct
+            if not (direct and self.direct_copy(src_fd, dest_fd, callback)):
+                copy_data(
+                    src_fd,
+                    dest_fd,
+                    callback,
+                    buffer_size=buffer_size,
+                    on_data=self.hash_source(),
+                )
+            if preallocated:
+                # In case the source got smaller in the meantime
+                os.ftruncate(dest_fd, os.lseek(dest_fd, 0, os.SEEK_CUR))
+
+        if cache_dropper:
+            cache_dropper.finish()
+
+    def direct_copy(self, src_fd: int, dest_fd: int, callback: Callback) -> bool:
+        """Try to copy data with O_DIRECT.
+
+        Return False if the filesystems do not support it
+
+        """
+        chunk_size = self.options.buffer_size or DIRECT_CHUNK_SIZE
+        try:
+            direct_copy(src_fd, dest_fd, callback, chunk_size=chunk_size)
+        except DirectIOUnsupported:
+            return False
+        return True
+
+    def hash_source(self) -> typing.Optional[DataCallback]:
+        """With --verify, return a callback hashing the data
+        of src while it is copied
+
+        """
+        if not self.options.verify:
+            return None
+        self.src_hasher = Hasher(self.options.verify)
+        return self.src_hasher.update
+
+    def verify(self, algorithm: str) -> None:
+        """Check that dest has the same checksum as src.
+
+        src is only read again if its data did not go
+        through userspace during the copy
+
+        """
+        try:
+            if self.src_hasher:
+                src_digest = self.src_hasher.hexdigest()
+            else:
+                src_digest = file_digest(self.src, algorithm)
+            dest_digest = file_digest(self.dest, algorithm)
+        except OSError as err:
+            raise TransferError("Could not verify %s: %s" % (self.dest, err))
+        if src_digest != dest_digest:
+            raise TransferError(
+                "Checksum mismatch: %s (%s) and %s (%s)"
+                % (self.src, src_digest, self.dest, dest_digest)
+            )
+        self.digest = dest_digest
 
     def post_transfer(self) -> None:
         """Handle state of transferred file
@@ -239,14 +1126,14 @@ class FileTransferManager:
         utime and flags.
 
         """
-        src_st = os.stat(self.src)
+        src_st = self.src_st
         if hasattr(os, "chmod"):
             mode = stat.S_IMODE(src_st.st_mode)
             os.chmod(self.dest, mode)
         if not self.options.preserve:
             return
         if hasattr(os, "utime"):
-            os.utime(self.dest, (src_st.st_atime, src_st.st_mtime))
+            os.utime(self.dest, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
         uid = src_st.st_uid
         gid = src_st.st_gid
         try:
@@ -257,28 +1144,46 @@ class FileTransferManager:
             pass
 
     def handle_overwrite(self) -> bool:
-        """Return True if we should skip the file.
-        Ask user for confirmation if we were called
-        with an 'interactive' option.
+        """Return True if we should skip the file"""
+        return skip_existing(self.dest, self.options)
 
-        """
-        # Safe: always skip
-        if self.options.safe:
-            print("Waning: skipping", self.dest)
-            return True
 
-        # Not safe and not interactive => overwrite
-        if not self.options.interactive:
-            return False
+def is_small_file(entry: Entry) -> bool:
+    return stat.S_ISREG(entry.st.st_mode) and entry.st.st_size < SMALL_FILE_SIZE
 
-        # Interactive
-        print("File: '%s' already exists" % self.dest)
-        print("Overwrite?")
-        user_input = input()
-        if user_input == "y":
-            return False
-        else:
-            return True
+
+class FileProgress:
+    """Progress of a file, or of a batch of small files.
+
+    Only the thread doing the transfer updates it, by incrementing
+    done. The progress renderer only reads it.
+
+    Once stop is set, the next update raises TransferInterrupted
+
+    """
+
+    def __init__(
+        self,
+        src: str,
+        dest: str,
+        size: int,
+        stop: typing.Optional[threading.Event] = None,
+    ) -> None:
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self.start = time.time()
+        self.done = 0
+        self.stop = stop
+
+    def add(self, transferred: int) -> None:
+        if self.stop is not None and self.stop.is_set():
+            raise TransferInterrupted()
+        self.done += transferred
+
+
+# src, and the error that occurred when transferring it, if any
+TransferResult = typing.Tuple[str, typing.Optional[Exception]]
 
 
 class TransferManager:
@@ -295,68 +1200,584 @@ class TransferManager:
         self.sources = sources
         self.destination = destination
         self.options = options
-        self.transfer_info = TransferInfo(sources, destination)
-
-        self.progress_indicator: ProgressIndicator = (
-            GlobalIndicator() if self.options.global_progress else OneFileIndicator()
+        # Created first, so that the scan is part of the total time
+        self.stats = Stats() if options.stats else None
+        self.syncer = Syncer(options.sync)
+        self.transfer_info = TransferInfo(
+            sources,
+            destination,
+            move=options.move,
+            streaming=options.stream,
+            skip_unchanged=options.skip_unchanged,
+            preserve_links=options.preserve_links,
+            dedupe=self.can_dedupe(),
+            in_place=options.resume or options.delta,
+            sparse=options.sparse != "never",
         )
-        self.last_progress_update = 0.0
-        self.last_progress: typing.Optional[Progress] = None
+
+        self.progress_indicator = self.make_progress_indicator()
+        # Protects self.progress, self.active, self.finished_size and
+        # calls to self.progress_indicator, which are shared by all the
+        # worker threads and the ticker
+        self.lock = threading.Lock()
+        self.progress = Progress()
+        self.total_start = 0.0
+        # Files being transferred
+        self.active: typing.List[FileProgress] = list()
+        # Number of bytes of the files already transferred
+        self.finished_size = 0
+        # Renders the progress of the last active file
+        self.ticker = Ticker(self.render)
+        # Set to interrupt the transfers running on worker threads
+        self.stop = threading.Event()
+        # With --delta, totals of FileTransferManager.delta_scanned
+        # and delta_written
+        self.delta_scanned = 0
+        self.delta_written = 0
+        # With --verify, checksums of the files transferred
+        self.manifest: typing.List[ManifestEntry] = list()
+        # With --dedupe, total size of the files that were linked
+        # or cloned instead of being copied
+        self.deduped_size = 0
+        # With --dedupe or --preserve-links, destinations written by
+        # this transfer, the only ones duplicates and links can
+        # safely be created from
+        self.track_written = bool(options.dedupe or options.preserve_links)
+        self.written: typing.Set[str] = set()
+
+    def can_dedupe(self) -> bool:
+        """Check if duplicates can be created from the copies of
+        the files they duplicate, so that the scan leaves them out
+
+        """
+        dedupe = self.options.dedupe
+        if dedupe is None:
+            return False
+        if dedupe == "link":
+            return True
+        return can_reflink(self.get_destination_dir())
+
+    def make_progress_indicator(self) -> ProgressIndicator:
+        mode = self.options.progress
+        if mode == "auto":
+            # Don't pay for rendering bars nobody will see
+            mode = "bar" if sys.stdout.isatty() else "none"
+        if mode == "none":
+            return ProgressIndicator()
+        if mode == "json":
+            fd = self.options.progress_fd
+            if fd is None:
+                return JsonIndicator()
+            return JsonIndicator(open(fd, "w", closefd=False))
+        # Per-file progress bars make no sense when several
+        # files are transferred at once
+        if self.options.global_progress or self.options.jobs > 1:
+            return GlobalIndicator()
+        return OneFileIndicator()
 
     def do_transfer(self) -> typing.Dict[str, Exception]:
         """Performs the real transfer"""
         errors: typing.Dict[str, Exception] = dict()
-        progress = Progress()
-        total_start = time.time()
-        progress.total_done = 0
-        progress.total_size = self.transfer_info.size
-        progress.index = 0
-        progress.count = len(self.transfer_info.to_transfer)
+        self.total_start = time.time()
+        if not self.options.stream:
+            self.rename_trees(errors)
+            if self.options.check_space:
+                self.check_free_space()
         self.progress_indicator.on_start()
+        self.ticker.start()
+        try:
+            if self.options.stream:
+                self.transfer_entries(self.transfer_info.stream(), errors)
+                # Directories that cannot be renamed after all
+                # are only known once the walk is over
+                self.rename_trees(errors)
+            self.transfer_entries(self.transfer_info.to_transfer, errors)
+            # Once all the targets exist. Duplicates first, since
+            # they can be the targets of links
+            self.dedupe_files(errors)
+            self.link_files(errors)
+        finally:
+            self.ticker.stop()
 
-        def on_file_transfer(transferred: int) -> None:
-            progress.file_done += transferred
-            progress.total_done += transferred
-            now = time.time()
-            progress.total_elapsed = now - total_start
-            progress.file_elapsed = now - file_start
-            self.last_progress = progress
-            if now - self.last_progress_update > 0.1:
-                self.progress_indicator.on_progress(progress)
-                self.last_progress_update = now
-
-        for src, dest, file_size in self.transfer_info.to_transfer:
-            file_start = time.time()
-            progress.index += 1
-            progress.src = src
-            progress.dest = dest
-            progress.file_size = file_size
-            progress.file_start = time.time()
-            progress.file_done = 0
-
-            ftm = FileTransferManager(src, dest, self.options)
-            ftm.set_callback(on_file_transfer)
-            self.progress_indicator.on_new_file(progress)
-            error = ftm.do_transfer()
-            if self.last_progress:
-                self.progress_indicator.on_progress(self.last_progress)
+        if self.syncer.policy != "none":
+            self.sync()
+        self.progress_indicator.on_finish()
+        if self.options.manifest:
+            write_manifest(self.options.manifest, self.manifest)
+        if self.options.move and not self.options.ignore_errors:
+            with measure(self.stats, "cleanup"):
+                self.remove_source_dirs()
+        if self.stats:
+            self.finish_stats()
+
+        return errors
+
+    def remove_source_dirs(self) -> None:
+        """When moving, remove the source directories
+        that are now empty
+
+        """
+        for to_remove in self.transfer_info.to_remove:
+            try:
+                os.rmdir(to_remove)
+            except OSError as error:
+                print(
+                    "Warning: Failed to remove ",
+                    to_remove,
+                    ":\n",
+                    error,
+                    end="\n",
+                    sep="",
+                    file=message_stream(self.options),
+                )
+
+    def finish_stats(self) -> None:
+        assert self.stats
+        transfer_info = self.transfer_info
+        self.stats.add_phase("scan", transfer_info.scan_time)
+        self.stats.add_phase("sync", self.syncer.elapsed)
+        self.stats.add_skipped(transfer_info.skipped, transfer_info.skipped_size)
+        self.stats.finish()
+
+    def transfer_entries(
+        self, entries: typing.Iterable[Entry], errors: typing.Dict[str, Exception]
+    ) -> None:
+        batches = self.make_batches(entries)
+        if self.options.jobs > 1:
+            results = self.transfer_files_in_parallel(batches)
+        else:
+            results = (self.transfer_batch(batch) for batch in batches)
+        for batch_results in results:
+            for src, error in batch_results:
+                if error:
+                    errors[src] = error
+                    with self.lock:
+                        self.progress_indicator.on_error(src, error)
+
+    def make_batches(
+        self, entries: typing.Iterable[Entry]
+    ) -> typing.Iterator[typing.List[Entry]]:
+        """Group consecutive small files into batches, so that
+        they can be transferred with less overhead.
+
+        Other files are yielded on their own
+
+        """
+        if not can_copy_small_files(self.options):
+            for entry in entries:
+                yield [entry]
+            return
+        batch: typing.List[Entry] = list()
+        for entry in entries:
+            if is_small_file(entry):
+                batch.append(entry)
+                if len(batch) >= SMALL_FILES_PER_BATCH:
+                    yield batch
+                    batch = list()
+                continue
+            if batch:
+                yield batch
+                batch = list()
+            yield [entry]
+        if batch:
+            yield batch
+
+    def transfer_batch(self, batch: typing.List[Entry]) -> typing.List[TransferResult]:
+        if len(batch) == 1 and not (
+            is_small_file(batch[0]) and can_copy_small_files(self.options)
+        ):
+            return [self.transfer_one(batch[0])]
+        return self.transfer_small_files(batch)
+
+    def transfer_files_in_parallel(
+        self, batches: typing.Iterable[typing.List[Entry]]
+    ) -> typing.Iterator[typing.List[TransferResult]]:
+        """Transfer batches of files using a pool of threads.
+
+        Results are yielded in the same order as the batches,
+        so that errors are collected deterministically.
+
+        """
+        jobs = self.options.jobs
+        pending: typing.Deque[
+            "Future[typing.List[TransferResult]]"
+        ] = collections.deque()
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            for batch in batches:
+                future = executor.submit(self.transfer_batch, batch)
+                pending.append(future)
+                # Don't queue millions of futures at once
+                if len(pending) >= 2 * jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        except BaseException:
+            # Interrupted, or something went wrong: don't start new
+            # transfers, and stop the running ones at their next chunk
+            # instead of waiting for them
+            self.stop.set()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+
+    def transfer_one(self, entry: Entry) -> TransferResult:
+        """Transfer one file, while the ticker renders its progress.
+
+        Returns src and the error that occurred, if any
+
+        """
+        src, dest = entry.src, entry.dest
+        file_progress = FileProgress(src, dest, entry.size, stop=self.stop)
+        ftm = FileTransferManager(
+            src,
+            dest,
+            self.options,
+            src_st=entry.st,
+            stats=self.stats,
+            syncer=self.syncer,
+        )
+        # The hot loop of the copy only increments an integer
+        ftm.set_callback(file_progress.add)
+        # Before the file becomes active, so that the ticker
+        # does not draw over the overwrite prompt
+        ftm.should_skip()
+        with self.lock:
+            self.progress.index += 1
+            self.active.append(file_progress)
+            self._update_progress(file_progress)
+            self.progress_indicator.on_new_file(self.progress)
+
+        start = time.perf_counter()
+        error = ftm.do_transfer()
+        if self.stats:
+            self.add_stats(ftm, error, entry.size, time.perf_counter() - start)
+
+        with self.lock:
+            self.delta_scanned += ftm.delta_scanned
+            self.delta_written += ftm.delta_written
+            if ftm.digest:
+                self.manifest.append((dest, ftm.digest))
+            if self.track_written and not (error or ftm.skipped):
+                self.written.add(dest)
+            self.active.remove(file_progress)
+            self.finished_size += file_progress.done
+            self._update_progress(file_progress)
+            self.progress_indicator.on_progress(self.progress)
             self.progress_indicator.on_file_done()
+        return src, error
+
+    def transfer_small_files(
+        self, batch: typing.List[Entry]
+    ) -> typing.List[TransferResult]:
+        """Transfer a batch of small files with copy_small_file(),
+        updating the progress only once for the whole batch
+
+        """
+        results: typing.List[TransferResult] = list()
+        last = batch[-1]
+        # The batch is displayed as if it was one big file
+        batch_progress = FileProgress(last.src, last.dest, 0)
+        written: typing.List[str] = list()
+        # Files actually copied, by position in the batch
+        copied_files: typing.List[typing.Tuple[int, Entry]] = list()
+        for position, entry in enumerate(batch):
+            if self.stop.is_set():
+                raise TransferInterrupted()
+            copied, error = self.transfer_small_file(entry)
+            if copied and not error:
+                written.append(entry.dest)
+                copied_files.append((position, entry))
+            results.append((entry.src, error))
+            batch_progress.size += entry.size
+        batch_progress.done = batch_progress.size
+
+        with self.lock:
+            if self.track_written:
+                self.written.update(written)
+            first_index = self.progress.index + 1
+            self.progress.index += len(batch)
+            self.finished_size += batch_progress.done
+            self._update_progress(batch_progress)
+            files: typing.List[BatchFile] = [
+                (first_index + position, entry.src, entry.dest, entry.size)
+                for position, entry in copied_files
+            ]
+            self.progress_indicator.on_batch(self.progress, files)
+        return results
+
+    def transfer_small_file(
+        self, entry: Entry
+    ) -> typing.Tuple[bool, typing.Optional[Exception]]:
+        """Transfer one file of a batch with copy_small_file().
+
+        Return whether it was copied, and the error ignored
+        while doing so if any
+
+        """
+        error: typing.Optional[Exception] = None
+        copied = False
+        stats = self.stats
+        start = time.perf_counter()
+        try:
+            copied = copy_small_file(entry.src, entry.dest, entry.st, self.options)
+            if copied:
+                sync_dest(self.syncer, entry.dest)
+        except TransferError as exception:
+            if not self.options.ignore_errors:
+                raise
+            error = exception
+            try:
+                os.remove(entry.dest)
+            except OSError:
+                # We don't want to raise here
+                pass
+        if stats:
+            duration = time.perf_counter() - start
+            stats.add_phase("small files", duration)
             if error:
+                stats.add_failed()
+            elif not copied:
+                stats.add_skipped(1, entry.size)
+            else:
+                stats.add_file(entry.src, entry.size, duration)
+        return copied, error
+
+    def add_stats(
+        self,
+        ftm: FileTransferManager,
+        error: typing.Optional[Exception],
+        size: int,
+        duration: float,
+    ) -> None:
+        assert self.stats
+        if error:
+            self.stats.add_failed()
+        elif ftm.skipped:
+            self.stats.add_skipped(1, size)
+        else:
+            self.stats.add_file(ftm.src, size, duration)
+
+    def render(self) -> None:
+        """Called periodically by the ticker to render the
+        progress of the last file being transferred
+
+        """
+        with self.lock:
+            if not self.active:
+                return
+            self._update_progress(self.active[-1])
+            self.progress_indicator.on_progress(self.progress)
+
+    def _update_progress(self, file_progress: FileProgress) -> None:
+        """Update self.progress, showing file_progress as the
+        current file. Must be called with the lock held
+
+        """
+        now = time.time()
+        progress = self.progress
+        self._refresh_totals()
+        progress.src = file_progress.src
+        progress.dest = file_progress.dest
+        progress.file_size = file_progress.size
+        progress.file_start = file_progress.start
+        progress.file_done = file_progress.done
+        progress.file_elapsed = now - file_progress.start
+        progress.total_done = self.finished_size + sum(x.done for x in self.active)
+        progress.total_elapsed = now - self.total_start
+
+    def _refresh_totals(self) -> None:
+        # When streaming, those keep growing while the walk proceeds
+        self.progress.total_size = self.transfer_info.size
+        self.progress.count = self.transfer_info.count
+
+    def sync(self) -> None:
+        """Flush what the --sync policy left to flush, and report
+        the time spent syncing
+
+        """
+        try:
+            self.syncer.finish(
+                self.get_destination_dir(), self.transfer_info.created_dirs
+            )
+        except OSError as err:
+            raise TransferError("Could not sync %s: %s" % (self.destination, err))
+        with self.lock:
+            self.progress.sync_elapsed = self.syncer.elapsed
+            self.progress_indicator.on_sync(self.progress)
+
+    def get_destination_dir(self) -> str:
+        """Return the destination if it is a directory, or
+        the directory where it will be created
+
+        """
+        destination = self.destination
+        if not os.path.isdir(destination):
+            destination = os.path.dirname(os.path.abspath(destination))
+        return destination
+
+    def check_free_space(self) -> None:
+        """Refuse to start a transfer that cannot fit on the
+        destination filesystem
+
+        """
+        destination = self.get_destination_dir()
+        try:
+            dest_dev = os.stat(destination).st_dev
+            st = os.statvfs(destination)
+        except OSError:
+            return
+        space_by_device = self.transfer_info.space_by_device
+        needed = sum(space_by_device.values())
+        same_device = space_by_device.get(dest_dev, 0)
+        if self.options.move:
+            # Files on the same device will just be renamed
+            needed -= same_device
+        elif (
+            same_device and self.options.reflink != "never" and can_reflink(destination)
+        ):
+            # Or cloned, which needs no space either
+            needed -= same_device
+        needed -= self.transfer_info.in_place_size
+        available = st.f_bavail * st.f_frsize
+        if needed > available:
+            raise TransferError(
+                "Not enough space left on %s: %s needed, only %s available"
+                % (destination, human_readable(needed), human_readable(available))
+            )
+
+    def link_files(self, errors: typing.Dict[str, Exception]) -> None:
+        """Recreate the hard links found during the scan,
+        removing their sources when moving.
+
+        Links that cannot be created this way are transferred
+        as usual
+
+        """
+        for src, target, dest in self.transfer_info.to_link:
+            try:
+                src_st = os.lstat(src)
+                can_link = self.can_link_to(src_st, target)
+                if can_link and link_file(target, dest, self.options):
+                    self.syncer.add(dest)
+                    if self.options.move:
+                        os.remove(src)
+            except OSError as err:
+                mess = "Could not link %s to %s: %s" % (dest, target, err)
+                error = TransferError(mess)
+                if not self.options.ignore_errors:
+                    raise error
                 errors[src] = error
+                continue
+            if can_link:
+                continue
+            src, transfer_error = self.transfer_instead(Entry(src, dest, src_st))
+            if transfer_error:
+                errors[src] = transfer_error
 
-        self.progress_indicator.on_finish()
-        if self.options.move and not self.options.ignore_errors:
-            for to_remove in self.transfer_info.to_remove:
-                try:
-                    os.rmdir(to_remove)
-                except OSError as error:
-                    print(
-                        "Warning: Failed to remove ",
-                        to_remove,
-                        ":\n",
-                        error,
-                        end="\n",
-                        sep="",
-                    )
+    def can_link_to(self, src_st: os.stat_result, target: str) -> bool:
+        """Check if target has the contents of the file described
+        by src_st, so that links to it can be created
 
-        return errors
+        """
+        with self.lock:
+            if target in self.written:
+                return True
+        # The transfer of target failed, or was skipped. Unless it
+        # was kept because it is up to date, an other file may be there
+        compare = self.options.skip_unchanged
+        target_st = lstat_or_none(target)
+        if compare and target_st:
+            return is_up_to_date(src_st, target_st, compare)
+        return False
+
+    def transfer_instead(self, entry: Entry) -> TransferResult:
+        """Transfer a file the scan expected to create from an
+        other one, and thus left out of the totals
+
+        """
+        with self.lock:
+            self.transfer_info.add(entry.src, entry.dest, entry.st)
+        return self.transfer_one(entry)
+
+    def dedupe_files(self, errors: typing.Dict[str, Exception]) -> None:
+        """Create the duplicates found during the scan from the
+        copies of the files they duplicate, removing their sources
+        when moving.
+
+        Duplicates that cannot be created this way are transferred
+        as usual
+
+        """
+        for entry, target in self.transfer_info.to_dedupe:
+            try:
+                deduped = self.dedupe_file(entry, target)
+            except OSError as err:
+                mess = "Could not dedupe %s from %s: %s" % (entry.dest, target, err)
+                error = TransferError(mess)
+                if not self.options.ignore_errors:
+                    raise error
+                errors[entry.src] = error
+                continue
+            if deduped:
+                continue
+            src, transfer_error = self.transfer_instead(entry)
+            if transfer_error:
+                errors[src] = transfer_error
+
+    def dedupe_file(self, entry: Entry, target: str) -> bool:
+        """Return False if entry must be transferred instead.
+
+        An existing destination kept because of the 'safe' or
+        'interactive' options counts as deduped, and its source is
+        left alone
+
+        """
+        with self.lock:
+            written = target in self.written
+        if not written:
+            # The transfer of target failed, or was skipped and
+            # an other file was kept there
+            return False
+        if self.options.dedupe == "link":
+            created = link_file(target, entry.dest, self.options)
+        else:
+            try:
+                created = clone_file(target, entry.dest, entry.st, self.options)
+            except ReflinkUnsupported:
+                return False
+        if not created:
+            return True
+        # Links to it can be created too
+        with self.lock:
+            self.written.add(entry.dest)
+        self.syncer.add(entry.dest)
+        if self.options.move:
+            os.remove(entry.src)
+        self.deduped_size += entry.size
+        return True
+
+    def rename_trees(self, errors: typing.Dict[str, Exception]) -> None:
+        """Rename the directories that are moved within the
+        same device, in one syscall per directory.
+
+        Directories that turn out to be on an other device
+        are parsed and transferred file by file instead.
+
+        """
+        for src, dest in self.transfer_info.to_rename:
+            try:
+                with measure(self.stats, "rename"):
+                    os.rename(src, dest)
+                self.transfer_info.created_dirs.append(dest)
+            except OSError as err:
+                if err.errno == errno.EXDEV:
+                    self.transfer_info.parse_dir_contents(src, dest)
+                    continue
+                mess = "Could not rename %s to %s: %s" % (src, dest, err)
+                error = TransferError(mess)
+                if not self.options.ignore_errors:
+                    raise error
+                errors[src] = error
@@ -0,0 +1,197 @@
+"""This module contains the TransferList class, a compact
+representation of the files to transfer.
+
+Transfers can involve tens of millions of files, so instead of
+keeping full paths and os.stat_result objects in memory, we store:
+
+* a directory tree, where each directory is a (parent index, name) record.
+  Source and destination directories share their record, since
+  their basenames are the same, except for the top-level ones
+* for each file: its directory index, its basename, and the
+  fields of its stat result, in arrays of machine integers.
+
+Full source and destination paths are only built when the list is iterated.
+
+Memory usage is about MEMORY_PER_FILE bytes per file,
+plus the basename itself (sys.getsizeof(basename), 49 bytes
+plus one byte per character for ASCII names on CPython)
+
+"""
+
+import array
+import os
+import stat
+import typing
+
+# Memory used for each file, not counting its basename.
+# See test_transfer_list.py
+MEMORY_PER_FILE = 96
+
+# Fields of os.stat_result kept for each file
+STAT_FIELDS = (
+    ("st_mode", "I"),
+    ("st_ino", "Q"),
+    ("st_dev", "Q"),
+    ("st_nlink", "I"),
+    ("st_uid", "I"),
+    ("st_gid", "I"),
+    ("st_size", "q"),
+    ("st_atime_ns", "q"),
+    ("st_mtime_ns", "q"),
+    ("st_ctime_ns", "q"),
+)
+
+
+class Entry(typing.NamedTuple):
+    """A file to transfer, with the result of lstat() on the source,
+    so that it is only called once per file
+
+    """
+
+    src: str
+    dest: str
+    st: os.stat_result
+
+    @property
+    def size(self) -> int:
+        """Number of bytes to transfer"""
+        if stat.S_ISLNK(self.st.st_mode):
+            return 0
+        return self.st.st_size
+
+
+def make_stat_result(values: typing.Sequence[int]) -> os.stat_result:
+    """Build an os.stat_result from the values of STAT_FIELDS"""
+    mode, ino, dev, nlink, uid, gid, size, atime_ns, mtime_ns, ctime_ns = values
+    times_ns = (atime_ns, mtime_ns, ctime_ns)
+    return os.stat_result(
+        (mode, ino, dev, nlink, uid, gid, size)
+        + tuple(x // 10**9 for x in times_ns)
+        + tuple(x / 10**9 for x in times_ns)
+        + times_ns
+    )
+
+
+class TransferList:
+    """A list of Entry objects, using as little memory as possible.
+
+    Entries are supposed to be appended in depth-first order,
+    the way TransferInfo walks the sources, so that the files
+    of a given directory are next to each other.
+
+    """
+
+    def __init__(self) -> None:
+        # Directories: parent index (-1 for top-level ones),
+        # then source and destination names (full paths for top-level ones)
+        self._dir_parents = array.array("q")
+        self._dir_src_names: typing.List[str] = list()
+        self._dir_dest_names: typing.List[str] = list()
+        # Stack of (src_path, dest_path, index) for the directory
+        # being filled and its parents
+        self._dir_stack: typing.List[typing.Tuple[str, str, int]] = list()
+
+        # Files
+        self._dirs = array.array("I")
+        self._names: typing.List[str] = list()
+        # Destination basenames, only for files renamed during the transfer
+        self._dest_names: typing.Dict[int, str] = dict()
+        self._stats = [array.array(code) for _, code in STAT_FIELDS]
+
+        # (index, src_path, dest_path) of the last directory used
+        # when building entries
+        self._last_dir: typing.Tuple[int, str, str] = (-1, "", "")
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __bool__(self) -> bool:
+        return len(self) != 0
+
+    def append(self, entry: Entry) -> None:
+        src_dir, src_name = os.path.split(entry.src)
+        dest_dir, dest_name = os.path.split(entry.dest)
+        index = len(self._names)
+        self._dirs.append(self._get_dir_index(src_dir, dest_dir))
+        self._names.append(src_name)
+        if dest_name != src_name:
+            self._dest_names[index] = dest_name
+        for (field, _), values in zip(STAT_FIELDS, self._stats):
+            values.append(getattr(entry.st, field))
+
+    def extend(self, entries: typing.Iterable[Entry]) -> None:
+        for entry in entries:
+            self.append(entry)
+
+    def __getitem__(self, index: int) -> Entry:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TransferList index out of range")
+        src_dir, dest_dir = self._get_dir_paths(self._dirs[index])
+        src_name = self._names[index]
+        dest_name = self._dest_names.get(index, src_name)
+        st = make_stat_result([values[index] for values in self._stats])
+        return Entry(
+            os.path.join(src_dir, src_name), os.path.join(dest_dir, dest_name), st
+        )
+
+    def __iter__(self) -> typing.Iterator[Entry]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def _get_dir_index(self, src_dir: str, dest_dir: str) -> int:
+        stack = self._dir_stack
+        while stack:
+            top_src, top_dest, top_index = stack[-1]
+            if (top_src, top_dest) == (src_dir, dest_dir):
+                return top_index
+            rel_src = relative_to(src_dir, top_src)
+            if rel_src is not None and rel_src == relative_to(dest_dir, top_dest):
+                # Sub-directory of the top of the stack: create the missing
+                # records, one per path component
+                parent = top_index
+                for name in rel_src.split(os.path.sep):
+                    top_src = os.path.join(top_src, name)
+                    top_dest = os.path.join(top_dest, name)
+                    parent = self._add_dir(parent, name, name)
+                    stack.append((top_src, top_dest, parent))
+                return parent
+            stack.pop()
+        index = self._add_dir(-1, src_dir, dest_dir)
+        stack.append((src_dir, dest_dir, index))
+        return index
+
+    def _add_dir(self, parent: int, src_name: str, dest_name: str) -> int:
+        self._dir_parents.append(parent)
+        self._dir_src_names.append(src_name)
+        # Share the string when both names are the same
+        self._dir_dest_names.append(src_name if dest_name == src_name else dest_name)
+        return len(self._dir_src_names) - 1
+
+    def _get_dir_paths(self, index: int) -> typing.Tuple[str, str]:
+        last_index, last_src, last_dest = self._last_dir
+        if index == last_index:
+            return last_src, last_dest
+        src_parts = list()
+        dest_parts = list()
+        current = index
+        while current != -1:
+            src_parts.append(self._dir_src_names[current])
+            dest_parts.append(self._dir_dest_names[current])
+            current = self._dir_parents[current]
+        src_path = os.path.join(*reversed(src_parts))
+        dest_path = os.path.join(*reversed(dest_parts))
+        self._last_dir = (index, src_path, dest_path)
+        return src_path, dest_path
+
+
+def relative_to(path: str, parent: str) -> typing.Optional[str]:
+    """Return path relative to parent, or None if path is not
+    inside parent
+
+    """
+    prefix = parent if parent.endswith(os.path.sep) else parent + os.path.sep
+    if not parent or not path.startswith(prefix):
+        return None
+    return path[len(prefix) :]
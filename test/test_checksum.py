@@ -0,0 +1,35 @@
+import hashlib
+import os
+import typing
+
+from pycp.checksum import Hasher, file_digest, write_manifest
+
+
+def test_hasher() -> None:
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    view = memoryview(bytearray(data))
+    hasher = Hasher("sha256")
+    # Small chunks first, hashed inline, then large ones,
+    # hashed on a separate thread
+    hasher.update(view[:10])
+    hasher.update(view[10 : 2 * 1024 * 1024])
+    hasher.update(view[2 * 1024 * 1024 :])
+
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert hasher.length == len(data)
+
+
+def test_file_digest(tmp_path: typing.Any) -> None:
+    path = str(tmp_path / "file.dat")
+    data = os.urandom(1024 * 1024 + 42)
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+    assert file_digest(path, "blake2b") == hashlib.blake2b(data).hexdigest()
+
+
+def test_write_manifest(tmp_path: typing.Any) -> None:
+    path = str(tmp_path / "SHA256SUMS")
+    write_manifest(path, [("b_file", "0123"), ("a_file", "4567")])
+    with open(path) as fp:
+        assert fp.read() == "4567  a_file\n0123  b_file\n"
@@ -0,0 +1,43 @@
+import os
+import typing
+
+import pycp.dedupe
+from pycp.dedupe import DuplicateFinder
+
+
+def write(path: str, data: bytes) -> str:
+    with open(path, "wb") as fp:
+        fp.write(data)
+    return path
+
+
+def test_find_duplicates(tmp_path: typing.Any) -> None:
+    data = os.urandom(100 * 1024)
+    original = write(str(tmp_path / "original"), data)
+    # Same size and same head, but a different tail
+    other = write(str(tmp_path / "other"), data[:-1] + b"x")
+    duplicate = write(str(tmp_path / "duplicate"), data)
+    finder = DuplicateFinder()
+
+    assert finder.find(original, "dest/original", len(data)) is None
+    assert finder.find(other, "dest/other", len(data)) is None
+    assert finder.find(duplicate, "dest/duplicate", len(data)) == "dest/original"
+
+
+def test_files_are_only_hashed_when_sizes_collide(
+    tmp_path: typing.Any, monkeypatch: typing.Any
+) -> None:
+    hashed: typing.List[str] = []
+    hash_file = pycp.dedupe.hash_file
+
+    def spy(path: str, limit: typing.Optional[int] = None) -> bytes:
+        hashed.append(os.path.basename(path))
+        return hash_file(path, limit)
+
+    monkeypatch.setattr(pycp.dedupe, "hash_file", spy)
+    finder = DuplicateFinder()
+    for name, data in [("a", b"a"), ("bb", b"bb"), ("c", b"c"), ("d", b"d")]:
+        path = write(str(tmp_path / name), data)
+        assert finder.find(path, name, len(data)) is None
+
+    assert hashed == ["a", "c", "d"]
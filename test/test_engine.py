@@ -0,0 +1,344 @@
+import errno
+import os
+import sys
+import typing
+
+import pytest
+
+import pycp.engine
+from pycp.engine import (
+    ChunkSize,
+    DirectIOUnsupported,
+    PageCacheDropper,
+    copy_data,
+    copy_sparse,
+    delta_copy,
+    direct_copy,
+    get_buffer,
+    has_holes,
+    preallocate,
+    same_data,
+    write_sparse,
+)
+
+
+def make_big_file(path: str, size: int) -> bytes:
+    data = bytes(i % 251 for i in range(size))
+    with open(path, "wb") as fp:
+        fp.write(data)
+    return data
+
+
+def copy_with_progress(
+    src: str, dest: str, buffer_size: typing.Optional[int] = None
+) -> typing.List[int]:
+    chunks: typing.List[int] = []
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        copy_data(
+            src_file.fileno(),
+            dest_file.fileno(),
+            chunks.append,
+            buffer_size=buffer_size,
+        )
+    return chunks
+
+
+def test_copy_data(tmp_path: typing.Any) -> None:
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 3 * 1024 * 1024 + 42)
+
+    chunks = copy_with_progress(src, dest)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+
+
+@pytest.mark.parametrize("error", [errno.EXDEV, errno.EINVAL, errno.ENOSYS])
+def test_falls_back_to_userspace_copy(
+    tmp_path: typing.Any, monkeypatch: typing.Any, error: int
+) -> None:
+    def unsupported(*args: typing.Any) -> int:
+        raise OSError(error, os.strerror(error))
+
+    monkeypatch.setattr(pycp.engine, "_copy_file_range_chunk", unsupported)
+    monkeypatch.setattr(pycp.engine, "_sendfile_chunk", unsupported)
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 2 * 1000 + 1)
+
+    chunks = copy_with_progress(src, dest, buffer_size=1000)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert chunks == [1000, 1000, 1]
+
+
+@pytest.mark.parametrize("platform", ["darwin", "freebsd13"])
+def test_no_sendfile_outside_linux(
+    tmp_path: typing.Any, monkeypatch: typing.Any, platform: str
+) -> None:
+    monkeypatch.setattr(sys, "platform", platform)
+    tiers = pycp.engine.kernel_copy_tiers()
+    assert pycp.engine._sendfile_chunk not in tiers
+
+    def unsupported(*args: typing.Any) -> int:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    # Without copy_file_range, this is a plain userspace copy
+    monkeypatch.setattr(pycp.engine, "_copy_file_range_chunk", unsupported)
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 2 * 1000 + 1)
+
+    chunks = copy_with_progress(src, dest, buffer_size=1000)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert chunks == [1000, 1000, 1]
+
+
+def test_userspace_copy_with_adaptive_chunks(
+    tmp_path: typing.Any, monkeypatch: typing.Any
+) -> None:
+    monkeypatch.setattr(pycp.engine, "kernel_copy_tiers", lambda: [])
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 5 * 1024 * 1024 + 3)
+
+    chunks = copy_with_progress(src, dest)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+
+
+def test_can_reflink_leaves_no_files(tmp_path: typing.Any) -> None:
+    # Whether the filesystem supports it or not
+    assert pycp.engine.can_reflink(str(tmp_path)) in (True, False)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_chunk_size_grows_while_throughput_improves() -> None:
+    chunk_size = ChunkSize(blksize=4096)
+    assert chunk_size.size == 4096 * pycp.engine.INITIAL_BLOCKS_PER_CHUNK
+
+    def throughput(size: int) -> float:
+        # Bigger chunks help up to 1 MiB, then make no difference
+        return float(min(size, 1024 * 1024))
+
+    for _ in range(100):
+        size = chunk_size.size
+        chunk_size.update(size, size / throughput(size))
+
+    assert chunk_size.size == 1024 * 1024
+    assert not chunk_size.adaptive
+
+
+def test_fixed_chunk_size() -> None:
+    chunk_size = ChunkSize(fixed=1234)
+    for _ in range(100):
+        chunk_size.update(1234, 1e-6)
+    assert chunk_size.size == 1234
+
+
+def test_buffer_is_reused() -> None:
+    first = get_buffer(4096)
+    second = get_buffer(1024)
+    assert first is second
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "copy_file_range"), reason="requires copy_file_range"
+)
+def test_real_errors_are_not_swallowed(
+    tmp_path: typing.Any, monkeypatch: typing.Any
+) -> None:
+    def no_space(*args: typing.Any) -> int:
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(pycp.engine, "_copy_file_range_chunk", no_space)
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    make_big_file(src, 10)
+
+    with pytest.raises(OSError):
+        copy_with_progress(src, dest)
+
+
+def make_sparse_file(path: str) -> bytes:
+    """Write 4 KiB of data, a 1 MiB hole, 4 KiB of data,
+    then a 1 MiB hole at the end
+
+    """
+    data = b"x" * 4096
+    with open(path, "wb") as fp:
+        fp.write(data)
+        fp.seek(1024 * 1024, os.SEEK_CUR)
+        fp.write(data)
+        fp.truncate(fp.tell() + 1024 * 1024)
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def allocated_size(path: str) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+def copy_sparse_with_progress(
+    src: str, dest: str, skip_zeros: bool = False
+) -> typing.List[int]:
+    chunks: typing.List[int] = []
+    size = os.path.getsize(src)
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        copy_sparse(
+            src_file.fileno(),
+            dest_file.fileno(),
+            size,
+            chunks.append,
+            skip_zeros=skip_zeros,
+        )
+    return chunks
+
+
+def test_copy_sparse_preserves_holes(tmp_path: typing.Any) -> None:
+    src = str(tmp_path / "src.img")
+    dest = str(tmp_path / "dest.img")
+    data = make_sparse_file(src)
+    with open(src, "rb") as fp:
+        if not has_holes(fp.fileno(), len(data)):
+            pytest.skip("filesystem does not support holes")
+
+    chunks = copy_sparse_with_progress(src, dest)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+    assert allocated_size(dest) < len(data) // 2
+
+
+def test_copy_sparse_detects_zeros(tmp_path: typing.Any) -> None:
+    src = str(tmp_path / "src.img")
+    dest = str(tmp_path / "dest.img")
+    data = b"y" * 100 + bytes(2 * 1024 * 1024) + b"z" * 5000
+    with open(src, "wb") as fp:
+        fp.write(data)
+
+    chunks = copy_sparse_with_progress(src, dest, skip_zeros=True)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+    with open(dest, "rb") as fp:
+        if has_holes(fp.fileno(), len(data)):
+            assert allocated_size(dest) < len(data) // 2
+
+
+def test_write_sparse_partial_blocks(tmp_path: typing.Any) -> None:
+    dest = str(tmp_path / "dest.dat")
+    buffer = bytearray(10000)
+    buffer[5000] = 1
+    buffer[-1] = 2
+    with open(dest, "wb") as fp:
+        write_sparse(fp.fileno(), buffer, len(buffer))
+        fp.truncate(len(buffer))
+    with open(dest, "rb") as fp:
+        assert fp.read() == buffer
+
+
+def test_preallocate(tmp_path: typing.Any) -> None:
+    dest = str(tmp_path / "dest.dat")
+    with open(dest, "wb") as fp:
+        if not preallocate(fp.fileno(), 1024 * 1024):
+            pytest.skip("filesystem does not support preallocation")
+    assert os.path.getsize(dest) == 1024 * 1024
+
+
+@pytest.mark.parametrize("size", [0, 4096, 3 * 4096 + 123, 5 * 1024 * 1024 + 1])
+def test_direct_copy(tmp_path: typing.Any, size: int) -> None:
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, size)
+    chunks: typing.List[int] = []
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        try:
+            direct_copy(src_file.fileno(), dest_file.fileno(), chunks.append)
+        except DirectIOUnsupported:
+            pytest.skip("filesystem does not support O_DIRECT")
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == size
+
+
+def test_page_cache_dropper(tmp_path: typing.Any, monkeypatch: typing.Any) -> None:
+    calls = []
+
+    def fake_fadvise(fd: int, offset: int, length: int, advice: str) -> None:
+        calls.append((offset, length, advice))
+
+    monkeypatch.setattr(pycp.engine, "fadvise", fake_fadvise)
+    monkeypatch.setattr(pycp.engine, "NOCACHE_WINDOW", 1000)
+    monkeypatch.setattr(pycp.engine, "kernel_copy_tiers", lambda: [])
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 2500)
+    chunks: typing.List[int] = []
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        dropper = PageCacheDropper(src_file.fileno(), dest_file.fileno())
+        callback = dropper.wrap(chunks.append)
+        copy_data(src_file.fileno(), dest_file.fileno(), callback, buffer_size=500)
+        dropper.finish()
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert calls[0] == (0, 0, "POSIX_FADV_SEQUENTIAL")
+    dropped = [x[:2] for x in calls if x[2] == "POSIX_FADV_DONTNEED"]
+    # Both files, every 1000 bytes, then whole files at the end
+    assert dropped == [(0, 1000)] * 2 + [(1000, 1000)] * 2 + [(0, 0)] * 2
+
+
+def test_same_data(tmp_path: typing.Any) -> None:
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 10000)
+    with open(dest, "wb") as fp:
+        fp.write(data[:5000] + b"x" + data[5001:8000])
+    with open(src, "rb") as src_file, open(dest, "rb") as dest_file:
+        src_fd, dest_fd = src_file.fileno(), dest_file.fileno()
+        assert same_data(src_fd, dest_fd, 0, 5000)
+        assert same_data(src_fd, dest_fd, 5001, 2999)
+        assert not same_data(src_fd, dest_fd, 4000, 2000)
+        # dest is too short
+        assert not same_data(src_fd, dest_fd, 7000, 2000)
+        assert os.lseek(src_fd, 0, os.SEEK_CUR) == 0
+
+
+@pytest.mark.parametrize(
+    "dest_size, expected_written",
+    [(0, 200_000), (1000, 200_000), (200_000, 65536), (300_000, 65536)],
+)
+def test_delta_copy(
+    tmp_path: typing.Any, dest_size: int, expected_written: int
+) -> None:
+    src = str(tmp_path / "src.dat")
+    dest = str(tmp_path / "dest.dat")
+    data = make_big_file(src, 200_000)
+    old_data = bytearray(data * 2)[:dest_size]
+    # Change one byte in the second block
+    if dest_size > 70_000:
+        old_data[70_000] ^= 0xFF
+    with open(dest, "wb") as fp:
+        fp.write(old_data)
+    chunks: typing.List[int] = []
+
+    with open(src, "rb") as src_file, open(dest, "r+b") as dest_file:
+        written = delta_copy(
+            src_file.fileno(), dest_file.fileno(), chunks.append, block_size=65536
+        )
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+    assert written == expected_written
@@ -1,13 +1,30 @@
+import os
+import shutil
+import signal
+import threading
+import time
 import typing
 
-from conftest import mock_term_size
+import pytest
+from conftest import mock_term_size, strip_ansi_colors
 
 import pycp.progress
 from pycp.progress import (
+    Bar,
+    Blue,
+    Counter,
+    Dash,
     GlobalIndicator,
+    Line,
     OneFileIndicator,
+    Reset,
+    Space,
+    TerminalWidth,
+    Text,
+    Ticker,
     shorten_path,
     shorten_string,
+    terminal_width,
 )
 
 
@@ -83,3 +100,48 @@ def test_indicates_progress_file_by_file() -> None:
     one_file_indicator.on_file_done()
 
     one_file_indicator.on_finish()
+
+
+def test_ticker() -> None:
+    ticks = threading.Semaphore(0)
+    ticker = Ticker(ticks.release, interval=0.01)
+    ticker.start()
+    for _ in range(3):
+        assert ticks.acquire(timeout=5)
+    ticker.stop()
+    # No more ticks once stopped
+    while ticks.acquire(blocking=False):
+        pass
+    time.sleep(0.05)
+    assert not ticks.acquire(blocking=False)
+
+
+def test_line_is_compiled(monkeypatch: typing.Any) -> None:
+    monkeypatch.setattr(shutil, "get_terminal_size", lambda: os.terminal_size((40, 25)))
+    terminal_width.invalidate()
+    line = Line([Blue(), Counter(), Reset(), Space(), Bar(), Dash(), Text("!")])
+
+    assert line.template == [Blue.seq, "", Reset.seq + " ", "", " - !"]
+    out = line.render(index=3, count=12, current_value=1, max_value=2)
+    assert strip_ansi_colors(out) == "[ 3/12] [" + "#" * 13 + " " * 13 + "] - !"
+    assert len(strip_ansi_colors(out)) == 40
+    terminal_width.invalidate()
+
+
+def test_terminal_width_is_refreshed_on_sigwinch(monkeypatch: typing.Any) -> None:
+    if not hasattr(signal, "SIGWINCH"):
+        pytest.skip("no SIGWINCH on this platform")
+    columns = [80]
+    monkeypatch.setattr(
+        shutil, "get_terminal_size", lambda: os.terminal_size((columns[0], 25))
+    )
+    width = TerminalWidth()
+    width.watch()
+    try:
+        assert width.get() == 80
+        columns[0] = 100
+        assert width.get() == 80
+        os.kill(os.getpid(), signal.SIGWINCH)
+        assert width.get() == 100
+    finally:
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL)
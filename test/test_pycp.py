@@ -1,15 +1,22 @@
+import hashlib
+import io
+import json
 import os
+import pstats
 import re
 import shutil
 import stat
 import sys
 import tempfile
 import time
+import tracemalloc
 import typing
 
 import pytest
 from conftest import mock_term_size, strip_ansi_colors
 
+import pycp.transfer
+from pycp.engine import ReflinkUnsupported
 from pycp.main import main as pycp_main
 
 
@@ -258,7 +265,7 @@ def test_output_does_not_wrap_1(
 
     expected_width = 90
     mock_term_size(mocker, expected_width)
-    sys.argv = ["pycp", a_file, a_file_back]
+    sys.argv = ["pycp", "--progress=bar", a_file, a_file_back]
     pycp_main()
     out, err = capsys.readouterr()
     lines = re.split(r"\r|\n", out)
@@ -278,10 +285,654 @@ def test_output_does_not_wrap_2(
     a_dir = os.path.join(test_dir, "a_dir")
     b_dir = os.path.join(test_dir, "b_dir")
 
-    sys.argv = ["pycp", "--global", a_dir, b_dir]
+    sys.argv = ["pycp", "--global", "--progress=bar", a_dir, b_dir]
     pycp_main()
 
     out, err = capsys.readouterr()
     lines = re.split(r"\r|\n", out)
     for line in lines:
         assert len(strip_ansi_colors(line)) <= expected_width
+
+
+def refuse_reflink(*args: typing.Any) -> None:
+    raise ReflinkUnsupported("not supported")
+
+
+def test_reflink_auto_falls_back_to_copy(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    """--reflink=auto should copy data when files cannot be cloned"""
+    monkeypatch.setattr(pycp.transfer, "reflink", refuse_reflink)
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    sys.argv = ["pycp", "--reflink=auto", a_file, a_copy]
+    pycp_main()
+    with open(a_copy, "r") as fp:
+        assert fp.read() == "a\n"
+
+
+def test_reflink_always_fails_when_unsupported(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    """--reflink=always should fail when files cannot be cloned"""
+    monkeypatch.setattr(pycp.transfer, "reflink", refuse_reflink)
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    sys.argv = ["pycp", "--reflink=always", a_file, a_copy]
+    with pytest.raises(SystemExit):
+        pycp_main()
+
+
+def test_reflink_never(test_dir: str, monkeypatch: typing.Any) -> None:
+    """--reflink=never should not even try to clone files"""
+
+    def fail(*args: typing.Any) -> None:
+        assert False, "reflink() should not be called"
+
+    monkeypatch.setattr(pycp.transfer, "reflink", fail)
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    sys.argv = ["pycp", "--reflink=never", a_file, a_copy]
+    pycp_main()
+    assert os.path.exists(a_copy)
+
+
+def test_parallel_copy(test_dir: str) -> None:
+    """cp --jobs should transfer every file"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    for i in range(20):
+        with open(os.path.join(a_dir, "file_%02d" % i), "w") as fp:
+            fp.write("%d\n" % i)
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pycp", "--jobs", "4", a_dir, b_dir]
+    pycp_main()
+    for i in range(20):
+        with open(os.path.join(b_dir, "file_%02d" % i), "r") as fp:
+            assert fp.read() == "%d\n" % i
+    assert os.path.exists(os.path.join(b_dir, ".hidden"))
+
+
+def test_progress_is_not_drawn_over_prompts(
+    test_dir: str, capsys: typing.Any, monkeypatch: typing.Any
+) -> None:
+    a_file = os.path.join(test_dir, "a_file")
+    b_file = os.path.join(test_dir, "b_file")
+    drawn_while_prompting = []
+
+    def slow_input() -> str:
+        capsys.readouterr()
+        time.sleep(0.3)
+        out, _ = capsys.readouterr()
+        drawn_while_prompting.append(out)
+        return "y"
+
+    monkeypatch.setattr("builtins.input", slow_input)
+    sys.argv = ["pycp", "--progress=bar", "-g", "-i", a_file, b_file]
+    pycp_main()
+
+    assert drawn_while_prompting == [""]
+
+
+def test_jobs_and_interactive(test_dir: str) -> None:
+    """--jobs cannot be used with --interactive"""
+    a_file = os.path.join(test_dir, "a_file")
+    b_file = os.path.join(test_dir, "b_file")
+    sys.argv = ["pycp", "--jobs", "2", "--interactive", a_file, b_file]
+    with pytest.raises(SystemExit):
+        pycp_main()
+
+
+@pytest.mark.parametrize("jobs", ["1", "3"])
+def test_streaming_copy(test_dir: str, jobs: str) -> None:
+    """cp --stream should transfer every file"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.mkdir(b_dir)
+    sys.argv = ["pycp", "--stream", "--jobs", jobs, a_dir, b_dir]
+    pycp_main()
+    for name in ("c_file", "d_file", "empty", ".hidden"):
+        assert os.path.exists(os.path.join(b_dir, "a_dir", name))
+
+
+@pytest.mark.parametrize("buffer_size", ["auto", "1", "4K", "1M"])
+def test_buffer_size(test_dir: str, buffer_size: str) -> None:
+    """cp --buffer-size should accept 'auto' or a size"""
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    sys.argv = ["pycp", "--buffer-size", buffer_size, a_file, a_copy]
+    pycp_main()
+    with open(a_copy, "r") as fp:
+        assert fp.read() == "a\n"
+
+
+@pytest.mark.parametrize("buffer_size", ["0", "-1", "lots", "12X"])
+def test_invalid_buffer_size(test_dir: str, buffer_size: str) -> None:
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    sys.argv = ["pycp", "--buffer-size", buffer_size, a_file, a_copy]
+    with pytest.raises(SystemExit):
+        pycp_main()
+
+
+@pytest.mark.parametrize("sparse", ["auto", "always", "never"])
+def test_sparse(test_dir: str, sparse: str) -> None:
+    """Sparse files should be copied whatever the --sparse option"""
+    src = os.path.join(test_dir, "disk.img")
+    with open(src, "wb") as fp:
+        fp.write(b"boot")
+        fp.truncate(1024 * 1024)
+    dest = os.path.join(test_dir, "disk.img.back")
+    sys.argv = ["pycp", "--sparse", sparse, src, dest]
+    pycp_main()
+    with open(src, "rb") as src_file, open(dest, "rb") as dest_file:
+        assert src_file.read() == dest_file.read()
+
+
+def test_copy_large_file(test_dir: str) -> None:
+    """Large files are preallocated, make sure they are copied correctly"""
+    src = os.path.join(test_dir, "big.dat")
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with open(src, "wb") as fp:
+        fp.write(data)
+    dest = os.path.join(test_dir, "big.dat.back")
+    sys.argv = ["pycp", src, dest]
+    pycp_main()
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_not_enough_space(test_dir: str, monkeypatch: typing.Any) -> None:
+    """Transfers that cannot fit in the destination should not start"""
+
+    def full_statvfs(path: str) -> os.statvfs_result:
+        return os.statvfs_result((4096, 4096, 1000, 0, 0, 100, 0, 0, 0, 255))
+
+    monkeypatch.setattr(os, "statvfs", full_statvfs)
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pycp", a_dir, b_dir]
+    with pytest.raises(SystemExit) as e:
+        pycp_main()
+    assert "Not enough space" in str(e.value)
+    assert not os.path.exists(os.path.join(b_dir, "c_file"))
+
+
+def small_statvfs(path: str) -> os.statvfs_result:
+    # 100 blocks of 4K available
+    return os.statvfs_result((4096, 4096, 1000, 100, 100, 1000, 1000, 1000, 0, 255))
+
+
+def test_sparse_files_need_less_space(test_dir: str, monkeypatch: typing.Any) -> None:
+    src = os.path.join(test_dir, "disk.img")
+    with open(src, "wb") as fp:
+        fp.write(b"boot")
+        fp.truncate(100 * 1024 * 1024)
+    if os.stat(src).st_blocks * 512 >= 400 * 1024:
+        pytest.skip("no sparse files on this filesystem")
+    monkeypatch.setattr(os, "statvfs", small_statvfs)
+    dest = os.path.join(test_dir, "disk.img.back")
+    sys.argv = ["pycp", src, dest]
+    pycp_main()
+    assert os.path.getsize(dest) == 100 * 1024 * 1024
+
+    # Unless holes are filled
+    sys.argv = ["pycp", "--sparse=never", src, dest]
+    with pytest.raises(SystemExit) as e:
+        pycp_main()
+    assert "Not enough space" in str(e.value)
+
+
+def test_clones_need_no_space(test_dir: str, monkeypatch: typing.Any) -> None:
+    src = os.path.join(test_dir, "big.dat")
+    with open(src, "wb") as fp:
+        fp.write(os.urandom(1024 * 1024))
+    dest = os.path.join(test_dir, "big.dat.back")
+    monkeypatch.setattr(os, "statvfs", small_statvfs)
+    monkeypatch.setattr(pycp.transfer, "can_reflink", lambda directory: True)
+    # Cloning is not supported here, but the check cannot tell
+    sys.argv = ["pycp", src, dest]
+    pycp_main()
+
+    sys.argv = ["pycp", "--reflink=never", src, dest]
+    with pytest.raises(SystemExit) as e:
+        pycp_main()
+    assert "Not enough space" in str(e.value)
+
+
+def test_no_space_check(test_dir: str, monkeypatch: typing.Any) -> None:
+    monkeypatch.setattr(os, "statvfs", small_statvfs)
+    src = os.path.join(test_dir, "big.dat")
+    with open(src, "wb") as fp:
+        fp.write(os.urandom(1024 * 1024))
+    dest = os.path.join(test_dir, "big.dat.back")
+    sys.argv = ["pycp", "--no-space-check", src, dest]
+    pycp_main()
+    assert os.path.getsize(dest) == 1024 * 1024
+
+
+@pytest.mark.parametrize("option", ["--delta", "--resume"])
+def test_in_place_updates_need_no_space(
+    test_dir: str, monkeypatch: typing.Any, option: str
+) -> None:
+    src = os.path.join(test_dir, "src.dat")
+    dest = os.path.join(test_dir, "dest.dat")
+    data = os.urandom(100 * 4096)
+    for path in (src, dest):
+        with open(path, "wb") as fp:
+            fp.write(data)
+
+    def full_statvfs(path: str) -> os.statvfs_result:
+        return os.statvfs_result((4096, 4096, 1000, 0, 0, 100, 0, 0, 0, 255))
+
+    monkeypatch.setattr(os, "statvfs", full_statvfs)
+    sys.argv = ["pycp", option, src, dest]
+    pycp_main()
+
+
+@pytest.mark.parametrize("option", ["--nocache", "--direct"])
+def test_spare_page_cache(test_dir: str, option: str) -> None:
+    """--nocache and --direct should not change what gets copied"""
+    src = os.path.join(test_dir, "big.dat")
+    data = os.urandom(2 * 1024 * 1024 + 17)
+    with open(src, "wb") as fp:
+        fp.write(data)
+    dest = os.path.join(test_dir, "big.dat.back")
+    sys.argv = ["pycp", option, src, dest]
+    pycp_main()
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_update(test_dir: str) -> None:
+    """--update should only rewrite files that changed"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.mkdir(b_dir)
+    sys.argv = ["pycp", "--preserve", a_dir, b_dir]
+    pycp_main()
+    # Same size, and newer than the source: should be left alone
+    kept = os.path.join(b_dir, "a_dir", "c_file")
+    with open(kept, "w") as fp:
+        fp.write("k\n")
+    with open(os.path.join(a_dir, "d_file"), "w") as fp:
+        fp.write("new contents\n")
+
+    sys.argv = ["pycp", "--update", a_dir, b_dir]
+    pycp_main()
+
+    with open(kept, "r") as fp:
+        assert fp.read() == "k\n"
+    with open(os.path.join(b_dir, "a_dir", "d_file"), "r") as fp:
+        assert fp.read() == "new contents\n"
+
+
+def test_delta(test_dir: str, capsys: typing.Any) -> None:
+    """--delta should only rewrite the blocks that changed"""
+    src = os.path.join(test_dir, "big.dat")
+    data = bytearray(os.urandom(4 * 1024 * 1024))
+    with open(src, "wb") as fp:
+        fp.write(data)
+    dest = os.path.join(test_dir, "big.dat.back")
+    data[1024 * 1024] ^= 0xFF
+    with open(dest, "wb") as fp:
+        fp.write(data)
+
+    sys.argv = ["pycp", "--delta", src, dest]
+    pycp_main()
+
+    with open(src, "rb") as src_file, open(dest, "rb") as dest_file:
+        assert src_file.read() == dest_file.read()
+    out, _ = capsys.readouterr()
+    assert "Delta: compared 4.0M, wrote 64K" in out
+
+
+def test_verify(test_dir: str) -> None:
+    """--manifest should list the checksums of the copies"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    with open(os.path.join(a_dir, "big.dat"), "wb") as fp:
+        fp.write(os.urandom(3 * 1024 * 1024))
+    b_dir = os.path.join(test_dir, "b_dir")
+    manifest = os.path.join(test_dir, "SHA256SUMS")
+    sys.argv = ["pycp", "--manifest", manifest, a_dir, b_dir]
+    pycp_main()
+
+    with open(manifest) as fp:
+        lines = fp.read().splitlines()
+    assert len(lines) == 5
+    for line in lines:
+        digest, path = line.split("  ")
+        with open(path, "rb") as fp:
+            assert hashlib.sha256(fp.read()).hexdigest() == digest
+
+
+def test_verify_mismatch(test_dir: str, monkeypatch: typing.Any) -> None:
+    """--verify should fail when the copy is not the same as its source"""
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    monkeypatch.setattr(pycp.transfer, "file_digest", lambda *args: "bogus")
+    sys.argv = ["pycp", "--verify-with", "md5", a_file, a_copy]
+    with pytest.raises(SystemExit) as e:
+        pycp_main()
+    assert "Checksum mismatch" in str(e.value)
+
+
+def read_events(text: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def test_json_progress(test_dir: str, capsys: typing.Any) -> None:
+    """--progress=json should emit one JSON event per line"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pycp", "--progress=json", "--jobs", "2", a_dir, b_dir]
+    pycp_main()
+
+    out, _ = capsys.readouterr()
+    events = read_events(out)
+    kinds = [x["event"] for x in events]
+    assert kinds[0] == "start"
+    assert kinds[-1] == "finish"
+    assert kinds.count("new_file") == kinds.count("file_done")
+    finish = events[-1]
+    assert finish["count"] == 4
+    assert finish["total_done"] == finish["total_size"] == 15
+    assert finish["errors"] == 0
+    # Small files are batched, but still reported one by one
+    new_files = {x["src"]: x["size"] for x in events if x["event"] == "new_file"}
+    assert new_files == {
+        os.path.join(a_dir, name): os.path.getsize(os.path.join(a_dir, name))
+        for name in os.listdir(a_dir)
+    }
+
+
+def test_json_progress_fd(
+    test_dir: str, capsys: typing.Any, monkeypatch: typing.Any
+) -> None:
+    """--progress-fd should send JSON events to the given fd, errors included"""
+
+    def fail(*args: typing.Any) -> None:
+        raise pycp.transfer.TransferError("no luck")
+
+    monkeypatch.setattr(pycp.transfer, "copy_small_file", fail)
+    a_file = os.path.join(test_dir, "a_file")
+    a_copy = os.path.join(test_dir, "a_copy")
+    events_path = os.path.join(test_dir, "events.json")
+    with open(events_path, "w") as fp:
+        sys.argv = [
+            "pycp",
+            "--progress=json",
+            "--progress-fd=%d" % fp.fileno(),
+            "--ignore-errors",
+            a_file,
+            a_copy,
+        ]
+        pycp_main()
+
+    out, _ = capsys.readouterr()
+    assert "{" not in out
+    with open(events_path) as fp:
+        events = read_events(fp.read())
+    assert events[-2] == {
+        "event": "error",
+        "src": a_file,
+        "message": "no luck",
+        "time": events[-2]["time"],
+    }
+    assert events[-1]["errors"] == 1
+
+
+def test_json_progress_keeps_stdout_parseable(
+    test_dir: str, capsys: typing.Any
+) -> None:
+    """With JSON events on stdout, messages should go to stderr"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.makedirs(os.path.join(b_dir, "a_dir"))
+    c_copy = os.path.join(b_dir, "a_dir", "c_file")
+    with open(c_copy, "w") as fp:
+        fp.write("KEEP")
+    sys.argv = ["pycp", "--progress=json", "--safe", "--stats", a_dir, b_dir]
+    pycp_main()
+
+    out, err = capsys.readouterr()
+    events = read_events(out)
+    assert events[-1]["event"] == "finish"
+    assert "Waning: skipping %s" % c_copy in err
+
+
+def test_no_bars_when_not_a_terminal(test_dir: str, capsys: typing.Any) -> None:
+    a_file = os.path.join(test_dir, "a_file")
+    sys.argv = ["pycp", a_file, os.path.join(test_dir, "a_copy")]
+    pycp_main()
+    out, _ = capsys.readouterr()
+    assert out == ""
+
+
+def test_stats(test_dir: str, capsys: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pycp", "--progress=none", "--stats", a_dir, b_dir]
+    pycp_main()
+
+    out, _ = capsys.readouterr()
+    assert "Statistics:" in out
+    assert "scan" in out
+    assert ", 4 files," in out
+    assert "rename" not in out
+    assert "Skipped: 0 files (0K), failed: 0 files" in out
+
+
+def test_profile_cpu(test_dir: str, capsys: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    output = os.path.join(test_dir, "pycp.prof")
+    sys.argv = ["pycp", "--profile=cpu", "--profile-output", output, a_dir, b_dir]
+    pycp_main()
+
+    out, _ = capsys.readouterr()
+    assert "do_transfer" in out
+    buf = io.StringIO()
+    pstats.Stats(output, stream=buf).print_stats()
+    assert "function calls" in buf.getvalue()
+
+
+def test_profile_alloc(test_dir: str, capsys: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    output = os.path.join(test_dir, "pycp.snapshot")
+    sys.argv = ["pycp", "--profile=alloc", "--profile-output", output, a_dir, b_dir]
+    pycp_main()
+
+    out, _ = capsys.readouterr()
+    assert "Peak traced memory" in out
+    assert tracemalloc.Snapshot.load(output).traces
+
+
+def test_preserve_links(test_dir: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.link(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_link"))
+    sys.argv = ["pycp", "--preserve-links", a_dir, b_dir]
+    pycp_main()
+
+    c_file_st = os.stat(os.path.join(b_dir, "c_file"))
+    assert c_file_st.st_nlink == 2
+    c_file = os.path.join(b_dir, "c_file")
+    assert os.path.samefile(c_file, os.path.join(b_dir, "z_link"))
+
+
+def make_linked_files(test_dir: str) -> typing.Tuple[str, str]:
+    """Return src, with two hard links a and b, and an empty dest"""
+    src = os.path.join(test_dir, "src")
+    dest = os.path.join(test_dir, "dest")
+    os.mkdir(src)
+    os.makedirs(os.path.join(dest, "src"))
+    with open(os.path.join(src, "a"), "w") as fp:
+        fp.write("data")
+    os.link(os.path.join(src, "a"), os.path.join(src, "b"))
+    return src, dest
+
+
+def test_preserve_links_interactive(test_dir: str, monkeypatch: typing.Any) -> None:
+    src, dest = make_linked_files(test_dir)
+    with open(os.path.join(dest, "src", "b"), "w") as fp:
+        fp.write("KEEP")
+    monkeypatch.setattr("builtins.input", lambda: "n")
+    sys.argv = ["pycp", "-i", "--preserve-links", src, dest]
+    pycp_main()
+
+    with open(os.path.join(dest, "src", "a")) as fp:
+        assert fp.read() == "data"
+    with open(os.path.join(dest, "src", "b")) as fp:
+        assert fp.read() == "KEEP"
+
+
+def test_preserve_links_to_kept_destinations(test_dir: str) -> None:
+    src, dest = make_linked_files(test_dir)
+    with open(os.path.join(dest, "src", "a"), "w") as fp:
+        fp.write("other")
+    sys.argv = ["pycp", "--safe", "--preserve-links", src, dest]
+    pycp_main()
+
+    with open(os.path.join(dest, "src", "a")) as fp:
+        assert fp.read() == "other"
+    with open(os.path.join(dest, "src", "b")) as fp:
+        assert fp.read() == "data"
+
+
+def test_preserve_links_to_up_to_date_destinations(test_dir: str) -> None:
+    src, dest = make_linked_files(test_dir)
+    shutil.copy2(os.path.join(src, "a"), os.path.join(dest, "src", "a"))
+    sys.argv = ["pycp", "--update", "--preserve-links", src, dest]
+    pycp_main()
+
+    assert os.path.samefile(
+        os.path.join(dest, "src", "a"), os.path.join(dest, "src", "b")
+    )
+
+
+def test_dedupe(test_dir: str, capsys: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    shutil.copy(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_copy"))
+    sys.argv = ["pycp", "--dedupe-links", a_dir, b_dir]
+    pycp_main()
+
+    c_file = os.path.join(b_dir, "c_file")
+    assert os.path.samefile(c_file, os.path.join(b_dir, "z_copy"))
+    out, _ = capsys.readouterr()
+    assert "Dedupe: saved" in out
+
+
+def test_dedupe_without_reflink_support(test_dir: str, monkeypatch: typing.Any) -> None:
+    def no_reflink(*args: typing.Any) -> None:
+        raise ReflinkUnsupported("not supported")
+
+    monkeypatch.setattr(pycp.transfer, "reflink", no_reflink)
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    shutil.copy(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_copy"))
+    sys.argv = ["pycp", "--dedupe", a_dir, b_dir]
+    pycp_main()
+
+    z_copy = os.path.join(b_dir, "z_copy")
+    assert not os.path.samefile(os.path.join(b_dir, "c_file"), z_copy)
+    with open(z_copy) as fp:
+        assert fp.read() == "c\n"
+
+
+def test_dedupe_fallback_in_totals(
+    test_dir: str, monkeypatch: typing.Any, capsys: typing.Any
+) -> None:
+    """Duplicates copied because cloning fails must be in the totals"""
+
+    def no_reflink(*args: typing.Any) -> None:
+        raise ReflinkUnsupported("not supported")
+
+    monkeypatch.setattr(pycp.transfer, "can_reflink", lambda directory: True)
+    monkeypatch.setattr(pycp.transfer, "reflink", no_reflink)
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    shutil.copy(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_copy"))
+    sys.argv = ["pycp", "--progress=json", "--dedupe", a_dir, b_dir]
+    pycp_main()
+
+    out, _ = capsys.readouterr()
+    events = read_events(out)
+    finish = events[-1]
+    assert finish["count"] == 5
+    assert finish["total_done"] == finish["total_size"] == 17
+    indexes = [x["index"] for x in events if x["event"] == "new_file"]
+    assert max(indexes) == 5
+
+
+@pytest.mark.parametrize("option", ["--dedupe", "--dedupe-links"])
+def test_dedupe_interactive(
+    test_dir: str, option: str, monkeypatch: typing.Any
+) -> None:
+    def fake_reflink(src_fd: int, dest_fd: int) -> None:
+        os.write(dest_fd, os.pread(src_fd, 4096, 0))
+
+    monkeypatch.setattr(pycp.transfer, "can_reflink", lambda directory: True)
+    monkeypatch.setattr(pycp.transfer, "reflink", fake_reflink)
+    src = os.path.join(test_dir, "src")
+    dest = os.path.join(test_dir, "dest")
+    os.makedirs(os.path.join(dest, "src"))
+    os.mkdir(src)
+    for name in ("a", "b"):
+        with open(os.path.join(src, name), "w") as fp:
+            fp.write("AAAA")
+    with open(os.path.join(dest, "src", "b"), "w") as fp:
+        fp.write("KEEP")
+    monkeypatch.setattr("builtins.input", lambda: "n")
+    sys.argv = ["pycp", "-i", option, src, dest]
+    pycp_main()
+
+    with open(os.path.join(dest, "src", "a")) as fp:
+        assert fp.read() == "AAAA"
+    with open(os.path.join(dest, "src", "b")) as fp:
+        assert fp.read() == "KEEP"
+
+
+def test_dedupe_ignores_kept_destinations(test_dir: str) -> None:
+    src = os.path.join(test_dir, "src")
+    dest = os.path.join(test_dir, "dest")
+    os.makedirs(os.path.join(dest, "src"))
+    os.mkdir(src)
+    for name in ("a", "b"):
+        with open(os.path.join(src, name), "w") as fp:
+            fp.write("AAAA")
+    with open(os.path.join(dest, "src", "a"), "w") as fp:
+        fp.write("ZZZZ")
+    sys.argv = ["pycp", "--safe", "--dedupe-links", src, dest]
+    pycp_main()
+
+    with open(os.path.join(dest, "src", "b")) as fp:
+        assert fp.read() == "AAAA"
+
+
+def test_dedupe_and_preserve_links(test_dir: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    # z_copy duplicates c_file, and z_link is a hard link to z_copy
+    shutil.copy(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_copy"))
+    os.link(os.path.join(a_dir, "z_copy"), os.path.join(a_dir, "z_link"))
+    sys.argv = ["pycp", "--preserve-links", "--dedupe-links", a_dir, b_dir]
+    pycp_main()
+
+    c_file = os.path.join(b_dir, "c_file")
+    assert os.path.samefile(c_file, os.path.join(b_dir, "z_copy"))
+    assert os.path.samefile(c_file, os.path.join(b_dir, "z_link"))
+
+
+@pytest.mark.parametrize("policy", ["file", "end", "dir"])
+def test_sync(test_dir: str, capsys: typing.Any, policy: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pycp", "--progress=json", "--sync", policy, a_dir, b_dir]
+    pycp_main()
+
+    assert os.path.exists(os.path.join(b_dir, "c_file"))
+    out, _ = capsys.readouterr()
+    events = [json.loads(line)["event"] for line in out.splitlines()]
+    assert events[-2:] == ["sync", "finish"]
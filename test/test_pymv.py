@@ -1,5 +1,7 @@
+import errno
 import os
 import sys
+import typing
 
 from pycp.main import main as pycp_main
 
@@ -51,3 +53,70 @@ def test_hidden(test_dir: str) -> None:
     pycp_main()
     hidden_copy = os.path.join(dest, "a_dir", ".hidden")
     assert os.path.exists(hidden_copy)
+
+
+def test_mv_renames_on_same_device(test_dir: str) -> None:
+    """mv within the same device should rename files instead of copying them"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    c_file = os.path.join(a_dir, "c_file")
+    a_file = os.path.join(test_dir, "a_file")
+    inodes = {os.stat(x).st_ino for x in (a_dir, c_file, a_file)}
+    dest = os.path.join(test_dir, "dest")
+    os.mkdir(dest)
+    sys.argv = ["pymv", a_dir, a_file, dest]
+    pycp_main()
+    moved = [
+        os.path.join(dest, "a_dir"),
+        os.path.join(dest, "a_dir", "c_file"),
+        os.path.join(dest, "a_file"),
+    ]
+    assert {os.stat(x).st_ino for x in moved} == inodes
+    assert not os.path.exists(a_dir)
+    assert not os.path.exists(a_file)
+
+
+def test_mv_across_devices(test_dir: str, monkeypatch: typing.Any) -> None:
+    """mv should copy then remove files when they cannot be renamed"""
+
+    def cross_device_rename(src: str, dest: str) -> None:
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "rename", cross_device_rename)
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    sys.argv = ["pymv", a_dir, b_dir]
+    pycp_main()
+    assert os.path.exists(os.path.join(b_dir, "c_file"))
+    assert os.path.exists(os.path.join(b_dir, ".hidden"))
+    assert not os.path.exists(a_dir)
+
+
+def test_mv_streaming(test_dir: str) -> None:
+    """mv --stream should rename directories once the walk is over"""
+    a_dir = os.path.join(test_dir, "a_dir")
+    a_file = os.path.join(test_dir, "a_file")
+    dest = os.path.join(test_dir, "dest")
+    os.mkdir(dest)
+    sys.argv = ["pymv", "--stream", a_dir, a_file, dest]
+    pycp_main()
+    assert os.path.exists(os.path.join(dest, "a_dir", "c_file"))
+    assert os.path.exists(os.path.join(dest, "a_file"))
+    assert not os.path.exists(a_dir)
+    assert not os.path.exists(a_file)
+
+
+def test_mv_preserve_links_across_devices(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    def cross_device_rename(src: str, dest: str) -> None:
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "rename", cross_device_rename)
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.link(os.path.join(a_dir, "c_file"), os.path.join(a_dir, "z_link"))
+    sys.argv = ["pymv", "--preserve-links", a_dir, b_dir]
+    pycp_main()
+    c_file = os.path.join(b_dir, "c_file")
+    assert os.path.samefile(c_file, os.path.join(b_dir, "z_link"))
+    assert not os.path.exists(a_dir)
@@ -0,0 +1,37 @@
+from pycp.stats import SLOWEST_COUNT, Stats, percentile
+
+
+def test_percentile() -> None:
+    values = [float(x) for x in range(1, 101)]
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 100
+    assert percentile([42.0], 90) == 42
+
+
+def test_slowest_files() -> None:
+    stats = Stats()
+    for i in range(SLOWEST_COUNT * 3):
+        stats.add_file("file_%02d" % i, 1024, duration=i / 10)
+
+    assert stats.files == SLOWEST_COUNT * 3
+    assert stats.size == SLOWEST_COUNT * 3 * 1024
+    slowest = sorted(x[2] for x in stats.slowest)
+    assert slowest == ["file_%02d" % i for i in range(20, 30)]
+
+
+def test_report() -> None:
+    stats = Stats()
+    stats.add_phase("copy", 1.5)
+    stats.add_phase("copy", 0.5)
+    stats.add_file("big_file", 4 * 1024 * 1024, duration=2.0)
+    stats.add_skipped(2, 2048)
+    stats.add_failed()
+    stats.finish()
+
+    report = stats.report()
+    assert "copy             2.00s" in report
+    # Phases that did not happen are not listed
+    assert "rename" not in report
+    assert "p50 2.0M/s" in report
+    assert "big_file" in report
+    assert "Skipped: 2 files (2K), failed: 1 files" in report
@@ -0,0 +1,71 @@
+import os
+import typing
+
+import pytest
+
+import pycp.sync
+from pycp.sync import Syncer
+
+
+@pytest.fixture
+def flushed(monkeypatch: typing.Any) -> typing.List[str]:
+    """Record what gets flushed, instead of flushing it"""
+    calls: typing.List[str] = []
+    monkeypatch.setattr(pycp.sync, "fsync_path", calls.append)
+    monkeypatch.setattr(pycp.sync, "datasync", lambda fd: calls.append("fd"))
+    monkeypatch.setattr(pycp.sync, "syncfs", lambda path: calls.append("fs"))
+    return calls
+
+
+def transfer(
+    syncer: Syncer, paths: typing.List[str], created_dirs: typing.List[str] = []
+) -> None:
+    for path in paths:
+        syncer.sync_file(42)
+        syncer.add(path)
+    syncer.finish(DEST, created_dirs)
+
+
+DEST = os.path.abspath("dest")
+A_DIR = os.path.join(DEST, "a")
+B_DIR = os.path.join(DEST, "b")
+PATHS = [
+    os.path.join(A_DIR, "1"),
+    os.path.join(A_DIR, "2"),
+    os.path.join(B_DIR, "3"),
+]
+
+
+def test_sync_none(flushed: typing.List[str]) -> None:
+    transfer(Syncer("none"), PATHS)
+    assert flushed == []
+
+
+def test_sync_file(flushed: typing.List[str]) -> None:
+    transfer(Syncer("file"), PATHS)
+    assert flushed == ["fd", "fd", "fd", B_DIR, A_DIR]
+
+
+@pytest.mark.parametrize("policy", ["file", "dir"])
+def test_sync_created_dirs(flushed: typing.List[str], policy: str) -> None:
+    transfer(Syncer(policy), PATHS, created_dirs=[DEST, A_DIR, B_DIR])
+    # The entries of the new directories are flushed too, up to
+    # the parent of the destination
+    assert flushed[-2:] == [DEST, os.path.dirname(DEST)]
+
+
+def test_sync_end(flushed: typing.List[str]) -> None:
+    transfer(Syncer("end"), PATHS)
+    assert flushed == ["fs"]
+
+
+def test_sync_dir(flushed: typing.List[str]) -> None:
+    syncer = Syncer("dir")
+    syncer.add(PATHS[0])
+    syncer.add(PATHS[1])
+    assert flushed == []
+    # Moving on to an other directory flushes the previous one
+    syncer.add(PATHS[2])
+    assert flushed == [PATHS[0], PATHS[1], A_DIR]
+    syncer.finish(DEST)
+    assert flushed[3:] == [PATHS[2], B_DIR]
@@ -0,0 +1,324 @@
+import os
+import threading
+import time
+import typing
+
+import pytest
+
+import pycp.transfer
+from pycp.transfer import (
+    FileTransferManager,
+    TransferError,
+    TransferInfo,
+    TransferManager,
+    TransferOptions,
+)
+
+
+def test_parallel_errors_are_collected_in_order(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    for i in range(30):
+        with open(os.path.join(a_dir, "file_%02d" % i), "w") as fp:
+            fp.write("%d\n" % i)
+
+    def fail_on_odd_files(self: pycp.transfer.FileTransferManager) -> None:
+        index = int(self.src[-2:]) if "file_" in self.src else 0
+        if index % 2:
+            raise TransferError("failed to transfer %s" % self.src)
+
+    monkeypatch.setattr(
+        pycp.transfer.FileTransferManager, "transfer_file", fail_on_odd_files
+    )
+    # Don't take the small files fast path
+    monkeypatch.setattr(pycp.transfer, "SMALL_FILE_SIZE", 0)
+    options = TransferOptions()
+    options.jobs = 8
+    options.ignore_errors = True
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_manager = TransferManager([a_dir], b_dir, options)
+
+    errors = transfer_manager.do_transfer()
+
+    expected = [os.path.join(a_dir, "file_%02d" % i) for i in range(1, 30, 2)]
+    assert list(errors.keys()) == expected
+
+
+def test_interrupting_parallel_transfers(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    def slow_transfer(self: pycp.transfer.FileTransferManager) -> None:
+        # A large file, copied chunk by chunk
+        for _ in range(400):
+            time.sleep(0.01)
+            self.callback(1)
+
+    monkeypatch.setattr(
+        pycp.transfer.FileTransferManager, "transfer_file", slow_transfer
+    )
+    monkeypatch.setattr(pycp.transfer, "SMALL_FILE_SIZE", 0)
+    options = TransferOptions()
+    options.jobs = 2
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_manager = TransferManager([a_dir], b_dir, options)
+    entries = list(transfer_manager.transfer_info.to_transfer)[:2]
+
+    def interrupted() -> typing.Iterator[pycp.transfer.Entry]:
+        yield from entries
+        time.sleep(0.1)
+        raise KeyboardInterrupt()
+
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        transfer_manager.transfer_entries(interrupted(), dict())
+    assert time.time() - start < 1
+    # The running transfers stopped too
+    time.sleep(0.1)
+    workers = [x for x in threading.enumerate() if x.name.startswith("ThreadPool")]
+    assert not any(x.is_alive() for x in workers)
+
+
+def test_streaming_refines_totals(test_dir: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_info = TransferInfo([a_dir], b_dir, streaming=True)
+    assert transfer_info.count == 0
+
+    seen = []
+    for entry in transfer_info.stream(queue_size=1):
+        # The destination directory must exist before the
+        # first file is yielded
+        assert os.path.isdir(os.path.dirname(entry.dest))
+        seen.append(entry.src)
+        assert transfer_info.count >= len(seen)
+
+    assert len(transfer_info.to_transfer) == 0
+    assert transfer_info.count == len(seen) == 4
+    assert transfer_info.size == sum(os.path.getsize(x) for x in seen)
+    assert transfer_info.to_remove == [a_dir]
+
+
+def test_streaming_forwards_scan_errors(test_dir: str, monkeypatch: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_info = TransferInfo([a_dir], b_dir, streaming=True)
+    monkeypatch.setattr(transfer_info, "walk", failing_walk)
+    with pytest.raises(OSError):
+        list(transfer_info.stream())
+
+
+def failing_walk(*args: typing.Any) -> typing.Iterator[typing.Any]:
+    yield from []
+    raise OSError("listdir failed")
+
+
+def test_scan_stats_files_once(test_dir: str, monkeypatch: typing.Any) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    for i in range(10):
+        with open(os.path.join(a_dir, "file_%02d" % i), "w") as fp:
+            fp.write("%d\n" % i)
+    calls = []
+
+    def counting(func: typing.Any) -> typing.Any:
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            calls.append(args[0])
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(os, "stat", counting(os.stat))
+    monkeypatch.setattr(os, "lstat", counting(os.lstat))
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_manager = TransferManager([a_dir], b_dir, TransferOptions())
+    transfer_manager.do_transfer()
+
+    # Source files are only stat'ed by os.scandir(), and small
+    # files are copied without checking their destination first
+    sources = [x for x in calls if str(x).startswith(a_dir + os.path.sep)]
+    assert sources == []
+    destinations = [x for x in calls if str(x).startswith(b_dir + os.path.sep)]
+    assert destinations == []
+
+
+@pytest.mark.parametrize("compare", ["mtime", "ctime"])
+def test_unchanged_files_are_not_counted(test_dir: str, compare: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    os.mkdir(b_dir)
+    TransferManager([a_dir], b_dir, TransferOptions()).do_transfer()
+    changed = os.path.join(a_dir, "c_file")
+    with open(changed, "w") as fp:
+        fp.write("changed\n")
+    future = os.stat(changed).st_mtime + 10
+    os.utime(changed, (future, future))
+    total = TransferInfo([a_dir], b_dir).size
+
+    transfer_info = TransferInfo([a_dir], b_dir, skip_unchanged=compare)
+
+    assert [entry.src for entry in transfer_info.to_transfer] == [changed]
+    assert transfer_info.size == os.path.getsize(changed)
+    assert transfer_info.skipped_size == total - transfer_info.size
+
+
+def test_preserved_old_files_are_unchanged_with_ctime(test_dir: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    old = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+    os.utime(os.path.join(a_dir, "c_file"), (old, old))
+    os.mkdir(b_dir)
+    options = TransferOptions()
+    options.preserve = True
+    TransferManager([a_dir], b_dir, options).do_transfer()
+
+    transfer_info = TransferInfo([a_dir], b_dir, skip_unchanged="ctime")
+
+    assert list(transfer_info.to_transfer) == []
+
+
+def resume_copy(src: str, dest: str) -> typing.List[int]:
+    options = TransferOptions()
+    options.resume = True
+    chunks: typing.List[int] = []
+    ftm = FileTransferManager(src, dest, options)
+    ftm.set_callback(chunks.append)
+    ftm.do_transfer()
+    return chunks
+
+
+def test_resume(test_dir: str) -> None:
+    src = os.path.join(test_dir, "big.dat")
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    with open(src, "wb") as fp:
+        fp.write(data)
+    dest = os.path.join(test_dir, "big.dat.back")
+    with open(dest, "wb") as fp:
+        fp.write(data[: 2 * 1024 * 1024 + 3])
+
+    chunks = resume_copy(src, dest)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert chunks[0] == 2 * 1024 * 1024 + 3
+    assert sum(chunks) == len(data)
+
+
+def test_resume_restarts_when_dest_differs(test_dir: str) -> None:
+    src = os.path.join(test_dir, "big.dat")
+    data = os.urandom(3 * 1024 * 1024)
+    with open(src, "wb") as fp:
+        fp.write(data)
+    dest = os.path.join(test_dir, "big.dat.back")
+    with open(dest, "wb") as fp:
+        fp.write(data[: 2 * 1024 * 1024] + b"garbage")
+
+    chunks = resume_copy(src, dest)
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == data
+    assert sum(chunks) == len(data)
+
+
+def test_resume_keeps_unrelated_files_when_safe(test_dir: str) -> None:
+    src = os.path.join(test_dir, "a_file")
+    dest = os.path.join(test_dir, "b_file")
+    with open(dest, "rb") as fp:
+        before = fp.read()
+    options = TransferOptions()
+    options.resume = True
+    options.safe = True
+
+    FileTransferManager(src, dest, options).do_transfer()
+
+    with open(dest, "rb") as fp:
+        assert fp.read() == before
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_small_files_are_batched(
+    test_dir: str, monkeypatch: typing.Any, jobs: int
+) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    for i in range(250):
+        with open(os.path.join(a_dir, "file_%03d" % i), "w") as fp:
+            fp.write("%d\n" % i)
+    os.chmod(os.path.join(a_dir, "file_042"), 0o000)
+    monkeypatch.setattr(pycp.transfer, "SMALL_FILES_PER_BATCH", 10)
+    new_files = []
+    monkeypatch.setattr(
+        pycp.transfer.GlobalIndicator,
+        "on_new_file",
+        lambda self, progress: new_files.append(progress.index),
+    )
+    options = TransferOptions()
+    options.ignore_errors = True
+    options.global_progress = True
+    options.jobs = jobs
+    b_dir = os.path.join(test_dir, "b_dir")
+    transfer_manager = TransferManager([a_dir], b_dir, options)
+
+    errors = transfer_manager.do_transfer()
+
+    for i in range(250):
+        if i == 42 and os.getuid() != 0:
+            continue
+        with open(os.path.join(b_dir, "file_%03d" % i)) as fp:
+            assert fp.read() == "%d\n" % i
+    if os.getuid() != 0:
+        assert list(errors.keys()) == [os.path.join(a_dir, "file_042")]
+    # 254 files, by batches of 10
+    assert len(new_files) == 26
+    assert new_files[-1] == 254
+
+
+def test_progress_is_rendered_by_the_ticker(
+    test_dir: str, monkeypatch: typing.Any
+) -> None:
+    src = os.path.join(test_dir, "big.dat")
+    with open(src, "wb") as fp:
+        fp.write(bytes(4 * 1024 * 1024))
+    rendered = []
+    monkeypatch.setattr(
+        pycp.transfer.OneFileIndicator,
+        "on_progress",
+        lambda self, progress: rendered.append(progress.file_done),
+    )
+
+    def slow_copy(
+        self: pycp.transfer.FileTransferManager, src_fd: int, dest_fd: int
+    ) -> None:
+        # The callback must not render anything itself
+        for _ in range(4):
+            self.callback(1024 * 1024)
+            assert rendered == []
+        time.sleep(0.3)
+
+    monkeypatch.setattr(pycp.transfer.FileTransferManager, "copy_file_data", slow_copy)
+    options = TransferOptions()
+    options.reflink = "never"
+    transfer_manager = TransferManager([src], src + ".back", options)
+    transfer_manager.do_transfer()
+
+    # Rendered by the ticker while sleeping, then once the file is done
+    assert len(rendered) >= 2
+    assert set(rendered) == {4 * 1024 * 1024}
+
+
+def test_hard_links_are_counted_once(test_dir: str) -> None:
+    a_dir = os.path.join(test_dir, "a_dir")
+    b_dir = os.path.join(test_dir, "b_dir")
+    c_file = os.path.join(a_dir, "c_file")
+    link = os.path.join(a_dir, "z_link")
+    os.link(c_file, link)
+    os.mkdir(b_dir)
+    b_a_dir = os.path.join(b_dir, "a_dir")
+    total = TransferInfo([a_dir], b_dir).size
+
+    transfer_info = TransferInfo([a_dir], b_dir, preserve_links=True)
+
+    assert transfer_info.size == total - os.path.getsize(c_file)
+    assert link not in [entry.src for entry in transfer_info.to_transfer]
+    assert transfer_info.to_link == [
+        (link, os.path.join(b_a_dir, "c_file"), os.path.join(b_a_dir, "z_link"))
+    ]
@@ -0,0 +1,62 @@
+import os
+import sys
+import tracemalloc
+import typing
+
+from pycp.transfer_list import MEMORY_PER_FILE, Entry, TransferList
+
+
+def make_entries(
+    src_root: str, dest_root: str, st: os.stat_result, count: int
+) -> typing.Iterator[Entry]:
+    for i in range(count):
+        sub_dir = os.path.join("dir_%03d" % (i // 100), "sub")
+        name = "file_%06d" % i
+        yield Entry(
+            os.path.join(src_root, sub_dir, name),
+            os.path.join(dest_root, sub_dir, name),
+            st,
+        )
+
+
+def test_round_trip(test_dir: str) -> None:
+    a_file = os.path.join(test_dir, "a_file")
+    st = os.lstat(a_file)
+    entries = [
+        Entry(a_file, os.path.join(test_dir, "a_file.back"), st),
+        Entry("b_file", "/path/to/b_file", st),
+    ]
+    entries.extend(make_entries("src", "/path/to/dest", st, 250))
+    entries.append(Entry("/other/c_file", "/path/to/dest/c_file", st))
+
+    transfer_list = TransferList()
+    transfer_list.extend(entries)
+
+    assert len(transfer_list) == len(entries)
+    assert list(transfer_list) == entries
+    assert transfer_list[-1] == entries[-1]
+    actual_st = transfer_list[0].st
+    assert actual_st.st_mtime_ns == st.st_mtime_ns
+    assert actual_st.st_mtime == st.st_mtime
+    assert actual_st.st_size == st.st_size
+    assert actual_st.st_mode == st.st_mode
+
+
+def test_memory_budget(test_dir: str) -> None:
+    st = os.lstat(os.path.join(test_dir, "a_file"))
+    count = 20_000
+    src_root = os.path.join(test_dir, "some", "source", "directory")
+    dest_root = os.path.join(test_dir, "some", "other", "destination")
+    name_size = sys.getsizeof("file_000000")
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        transfer_list = TransferList()
+        transfer_list.extend(make_entries(src_root, dest_root, st, count))
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    assert len(transfer_list) == count
+    assert used / count <= MEMORY_PER_FILE + name_size